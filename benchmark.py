@@ -0,0 +1,578 @@
+"""Offline load test for the leave bot
+
+Drives the real handlers (request_command -> handle_dates -> handle_hours ->
+handle_remarks -> handle_response, /pending bulk approval and check_balance)
+with synthetic Updates, against an in-process fake Bot and an in-memory stand-in
+for gspread with configurable latency and 429 errors. Needs no network access.
+
+Usage:
+    python benchmark.py                      # run every scenario
+    python benchmark.py leave_burst --users 200 --sheets-latency 0.3
+
+Each run is appended to benchmark_results.json and compared with the previous
+run of the same scenario and settings, so regressions show up.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+import gspread
+from gspread.exceptions import APIError
+from telegram import Chat, Message, Update, User
+from telegram.error import RetryAfter
+from telegram.ext import ExtBot
+
+SUPERVISOR_GROUP_ID = -1001
+DUTY_OPS_GROUP_ID = -1002
+SUPERVISOR_ID = 900001
+DUTY_OPS_ID = 900002
+ADMIN_ID = 900003
+TEAMS = 5
+FIRST_USER_ID = 100000
+RESULTS_FILE = "benchmark_results.json"
+# A p95 or Sheets call count this much worse than the previous run is flagged
+REGRESSION_THRESHOLD = 0.2
+
+class FakeAPIResponse:
+    """Just enough of requests.Response for gspread's APIError"""
+    def __init__(self, code, message, status):
+        self.status_code = code
+        self.text = message
+        self.error = {'code': code, 'message': message, 'status': status}
+
+    def json(self):
+        return {'error': self.error}
+
+class FakeSheetsBackend:
+    """Thread-safe in-memory stand-in for the parts of gspread the bot uses
+
+    Every method that would be an API request sleeps for `latency` seconds (in the
+    calling thread, like a real HTTP round-trip) and fails with a 429 quota error
+    with probability `error_rate`.
+    """
+    def __init__(self, balance_rows, history_rows, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.errors = Counter()
+        self.worksheets = [
+            FakeWorksheet(self, 0, "Sheet1", balance_rows),
+            FakeWorksheet(self, 1, "Leave History", history_rows)
+        ]
+
+    def request(self, operation):
+        """Account for one API request"""
+        with self.lock:
+            self.calls[operation] += 1
+            fail = self.random.random() < self.error_rate
+            if fail:
+                self.errors[operation] += 1
+        time.sleep(self.latency)
+        if fail:
+            raise APIError(FakeAPIResponse(
+                429, "Quota exceeded for quota metric 'Read requests'", "RESOURCE_EXHAUSTED"
+            ))
+
+    def open_by_key(self, key):
+        self.request('open_by_key')
+        return FakeSpreadsheet(self, key)
+
+class FakeSpreadsheet:
+    def __init__(self, backend, key):
+        self.backend = backend
+        self.id = key
+
+    @property
+    def sheet1(self):
+        return self.get_worksheet(0)
+
+    def get_worksheet(self, index):
+        self.backend.request('fetch_sheet_metadata')
+        return self.backend.worksheets[index]
+
+    def worksheet(self, title):
+        self.backend.request('fetch_sheet_metadata')
+        for worksheet in self.backend.worksheets:
+            if worksheet.title == title:
+                return worksheet
+        raise gspread.exceptions.WorksheetNotFound(title)
+
+    def batch_update(self, body):
+        self.backend.request('batch_update')
+        with self.backend.lock:
+            for request in body['requests']:
+                if 'updateCells' in request:
+                    update = request['updateCells']
+                    grid = update['range']
+                    worksheet = self.backend.worksheets[grid['sheetId']]
+                    for offset, row in enumerate(update['rows']):
+                        for col_offset, cell in enumerate(row['values']):
+                            worksheet.set(
+                                grid['startRowIndex'] + offset + 1,
+                                grid['startColumnIndex'] + col_offset + 1,
+                                cell_value(cell)
+                            )
+                elif 'appendCells' in request:
+                    append = request['appendCells']
+                    worksheet = self.backend.worksheets[append['sheetId']]
+                    for row in append['rows']:
+                        worksheet.rows.append([cell_value(cell) for cell in row['values']])
+        return {'replies': [{} for _ in body['requests']]}
+
+class FakeWorksheet:
+    def __init__(self, backend, sheet_id, title, rows):
+        self.backend = backend
+        self.id = sheet_id
+        self.title = title
+        self.rows = rows
+
+    def set(self, row, col, value):
+        while len(self.rows) < row:
+            self.rows.append([])
+        cells = self.rows[row - 1]
+        while len(cells) < col:
+            cells.append('')
+        cells[col - 1] = value
+
+    def get_all_values(self):
+        self.backend.request('values_get')
+        with self.backend.lock:
+            return [list(row) for row in self.rows]
+
+    def get(self, range_name):
+        """Rows for an "A:B" row range; like the API, trailing empty rows are left out"""
+        self.backend.request('values_get')
+        with self.backend.lock:
+            return self._range(range_name)
+
+    def _range(self, range_name):
+        first, last = (int(part) for part in range_name.split(':'))
+        rows = [list(row) for row in self.rows[first - 1:last]]
+        while rows and not any(rows[-1]):
+            rows.pop()
+        return rows
+
+    def batch_get(self, ranges):
+        """Rows for several "A:B" row ranges in one values.batchGet request"""
+        self.backend.request('values_batch_get')
+        with self.backend.lock:
+            return [self._range(range_name) for range_name in ranges]
+
+def cell_value(cell):
+    """The formatted string Sheets would return for a CellData"""
+    value = cell.get('userEnteredValue', {})
+    if 'numberValue' in value:
+        return f"{value['numberValue']:g}"
+    if 'boolValue' in value:
+        return 'TRUE' if value['boolValue'] else 'FALSE'
+    return value.get('stringValue', '')
+
+class FakeBot(ExtBot):
+    """Bot that counts outgoing calls instead of talking to Telegram"""
+    def __init__(self, latency=0.0, retry_after_rate=0.0, seed=0):
+        super().__init__(token="123456:BENCHMARK")
+        # Telegram objects refuse new attributes once constructed
+        with self._unfrozen():
+            self._fake_latency = latency
+            self._fake_retry_after_rate = retry_after_rate
+            self._fake_random = random.Random(seed)
+            self.calls = Counter()
+            self.retry_afters = Counter()
+
+    async def get_me(self, *args, **kwargs):
+        self._bot_user = User(id=123456, is_bot=True, first_name="Benchmark", username="benchmark_bot")
+        return self._bot_user
+
+    async def _fake_request(self, method):
+        self.calls[method] += 1
+        await asyncio.sleep(self._fake_latency)
+        if self._fake_random.random() < self._fake_retry_after_rate:
+            self.retry_afters[method] += 1
+            raise RetryAfter(1)
+
+    async def send_message(self, chat_id, text, *args, **kwargs):
+        await self._fake_request('sendMessage')
+        with self._unfrozen():
+            self._fake_message_id = getattr(self, '_fake_message_id', 0) + 1
+        return Message(self._fake_message_id, datetime.now(), Chat(chat_id, Chat.PRIVATE), text=text)
+
+    async def edit_message_text(self, text, *args, **kwargs):
+        await self._fake_request('editMessageText')
+
+    async def edit_message_reply_markup(self, *args, **kwargs):
+        await self._fake_request('editMessageReplyMarkup')
+
+    async def answer_callback_query(self, callback_query_id, *args, **kwargs):
+        await self._fake_request('answerCallbackQuery')
+
+    async def send_document(self, chat_id, document, *args, **kwargs):
+        await self._fake_request('sendDocument')
+
+class UpdateFactory:
+    """Builds Telegram Updates the way the Bot API would deliver them"""
+    def __init__(self, bot):
+        self.bot = bot
+        self.ids = itertools.count(1)
+
+    def user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}", 'username': f"user{user_id}"}
+
+    def message(self, user_id, text, chat_id=None):
+        message = {
+            'message_id': next(self.ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'} if chat_id is None else
+                    {'id': chat_id, 'type': 'supergroup', 'title': 'Approvers'},
+            'from': self.user(user_id),
+            'text': text
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return Update.de_json({'update_id': next(self.ids), 'message': message}, self.bot)
+
+    def callback(self, user_id, chat_id, data, message_id=None):
+        update_id = next(self.ids)
+        return Update.de_json({
+            'update_id': update_id,
+            'callback_query': {
+                'id': str(update_id),
+                'from': self.user(user_id),
+                'chat_instance': str(chat_id),
+                'data': data,
+                'message': {
+                    'message_id': message_id or next(self.ids),
+                    'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'supergroup', 'title': 'Approvers'},
+                    'text': 'Leave request'
+                }
+            }
+        }, self.bot)
+
+def balance_rows(users):
+    rows = [['Name', 'Handle', 'Telegram ID', 'Balance', 'Team']]
+    for user_id in users:
+        rows.append([f"User{user_id}", f"user{user_id}", str(user_id), '160', f"Team {user_id % TEAMS}"])
+    return rows
+
+def history_rows(users, count, seed=0):
+    """Leave History rows spread over the last two years, in the bot's own format"""
+    rng = random.Random(seed)
+    rows = [[
+        'Timestamp', 'Name', 'Handle', 'Start Date', 'End Date', 'Hours',
+        'Total Hours', 'Remarks', 'Request ID', 'Supervisor', 'Duty Ops'
+    ]]
+    now = time.time()
+    for i in range(count):
+        user_id = rng.choice(users)
+        stamp = datetime.fromtimestamp(now - rng.randrange(0, 2 * 365 * 86400))
+        day = stamp.strftime("%Y-%m-%d")
+        rows.append([
+            stamp.strftime("%Y-%m-%d %H:%M:%S"), f"User{user_id}", f"user{user_id}", day, day,
+            '8', '8', 'Synthetic', f"REQ_{stamp.strftime('%Y%m%d%H%M%S')}{i}_{user_id}",
+            'Supervisor', 'Duty Ops'
+        ])
+    return rows
+
+def load_leave_bot(workdir, **settings):
+    """Import leave_bot and configure it with stand-in settings, ignoring config.py"""
+    import leave_bot
+    leave_bot.load_config(
+        BOT_TOKEN="123456:BENCHMARK",
+        SUPERVISOR_GROUP_ID=SUPERVISOR_GROUP_ID,
+        DUTY_OPS_GROUP_ID=DUTY_OPS_GROUP_ID,
+        SPREADSHEET_ID="benchmark",
+        CREDENTIALS_FILE=os.devnull,
+        PENDING_DB_FILE=os.path.join(workdir, 'pending_requests.db'),
+        LEDGER_DB_FILE=os.path.join(workdir, 'ledger.db'),
+        **settings
+    )
+    return leave_bot
+
+class Recorder:
+    """Collects per-step latencies and handler errors"""
+    def __init__(self, application):
+        self.application = application
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        application.add_error_handler(self.on_error)
+
+    async def on_error(self, update, context):
+        self.errors[type(context.error).__name__] += 1
+
+    async def send(self, step, update):
+        """Process one update through the same path the update fetcher uses"""
+        application = self.application
+        start = time.perf_counter()
+        await application.update_processor.process_update(update, application.process_update(update))
+        self.latencies[step].append(time.perf_counter() - start)
+
+async def request_leave(recorder, factory, users):
+    """Every user walks through /request at once"""
+    # After all synthetic history, so no request overlaps earlier leave
+    start_day = datetime.now() + timedelta(days=30)
+    dates = f"{start_day:%Y-%m-%d} to {start_day + timedelta(days=4):%Y-%m-%d}"
+
+    async def request(user_id):
+        for step, text in (
+            ('request_command', '/request'),
+            ('handle_dates', dates),
+            ('handle_hours', '8,8,4,8,8'),
+            ('handle_remarks', 'Benchmark leave')
+        ):
+            await recorder.send(step, factory.message(user_id, text))
+
+    await asyncio.gather(*(request(user_id) for user_id in users))
+
+async def approve_each(recorder, factory):
+    """Supervisors, then Duty Ops, press Approve on every pending request at once"""
+    request_ids = list(recorder.application.bot_data['pending_requests'])
+    await asyncio.gather(*(
+        recorder.send(
+            'supervisor_approve',
+            factory.callback(SUPERVISOR_ID, SUPERVISOR_GROUP_ID, f"supervisor_approve_{request_id}")
+        )
+        for request_id in request_ids
+    ))
+    await asyncio.gather(*(
+        recorder.send(
+            'dutyops_approve',
+            factory.callback(DUTY_OPS_ID, DUTY_OPS_GROUP_ID, f"dutyops_approve_{request_id}")
+        )
+        for request_id in request_ids
+    ))
+
+async def leave_burst(leave_bot, recorder, factory, args):
+    """Every user requests leave at once, then supervisors and Duty Ops approve everything"""
+    users = [FIRST_USER_ID + i for i in range(args.users)]
+    await request_leave(recorder, factory, users)
+    await approve_each(recorder, factory)
+    return users
+
+async def one_message(leave_bot, recorder, factory, args):
+    """Like leave_burst, but every user sends the whole request as one /request message"""
+    users = [FIRST_USER_ID + i for i in range(args.users)]
+    start_day = datetime.now() + timedelta(days=30)
+    text = f'/request {start_day:%Y-%m-%d}..{start_day + timedelta(days=13):%Y-%m-%d} 8 weekdays "Benchmark leave"'
+    await asyncio.gather(*(recorder.send('request_command', factory.message(user_id, text)) for user_id in users))
+    await approve_each(recorder, factory)
+    return users
+
+async def bulk_approval(leave_bot, recorder, factory, args):
+    """Every user requests leave, then each stage approves them from /pending lists"""
+    users = [FIRST_USER_ID + i for i in range(args.users)]
+    await request_leave(recorder, factory, users)
+    pending = recorder.application.bot_data['pending_requests']
+    for stage, approver_id, chat_id in (
+        ('supervisor', SUPERVISOR_ID, SUPERVISOR_GROUP_ID),
+        ('dutyops', DUTY_OPS_ID, DUTY_OPS_GROUP_ID)
+    ):
+        status = leave_bot.approval_stage(chat_id)
+        # Each list shows at most PENDING_LIST_LIMIT requests
+        while any(request.status == status for request in pending.values()):
+            await recorder.send(f'{stage}_pending', factory.message(approver_id, '/pending', chat_id=chat_id))
+            # Open lists are keyed "chat_id:message_id", newest last
+            key = next(reversed(leave_bot.shared_state.namespaces['pending_lists']))
+            message_id = int(key.rpartition(':')[2])
+            await recorder.send(
+                f'{stage}_approve_all',
+                factory.callback(approver_id, chat_id, 'pending_approve_all', message_id=message_id)
+            )
+    return users
+
+async def history_report(leave_bot, recorder, factory, args):
+    """An admin asks for last month's report twice (the second is cached), then a whole year"""
+    year_ago = datetime.now() - timedelta(days=365)
+    for step, text in (
+        ('report_month', '/report'),
+        ('report_month_cached', '/report'),
+        ('report_year', f"/report {year_ago:%Y-%m-%d} {datetime.now():%Y-%m-%d}")
+    ):
+        await recorder.send(step, factory.message(ADMIN_ID, text))
+    return [ADMIN_ID]
+
+async def balance_history(leave_bot, recorder, factory, args):
+    """Every user checks their balance at once, twice, against a long Leave History"""
+    users = [FIRST_USER_ID + i for i in range(args.users)]
+    for step in ('check_balance', 'check_balance_again'):
+        await asyncio.gather(*(recorder.send(step, factory.message(user_id, '/balance')) for user_id in users))
+    return users
+
+SCENARIOS = {
+    'leave_burst': leave_burst,
+    'one_message': one_message,
+    'bulk_approval': bulk_approval,
+    'balance_history': balance_history,
+    'history_report': history_report
+}
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+async def run_scenario(name, args):
+    """Run one scenario in this process and return its results"""
+    workdir = tempfile.mkdtemp(prefix="leave_bot_bench_")
+    settings = {'ADMIN_IDS': [ADMIN_ID], 'BALANCE_TEAM_COLUMN': 5}
+    if not args.telegram_limits:
+        settings.update(TELEGRAM_GLOBAL_RATE=float('inf'), PRIVATE_CHAT_INTERVAL=0, GROUP_CHAT_INTERVAL=0)
+    leave_bot = load_leave_bot(workdir, **settings)
+
+    users = [FIRST_USER_ID + i for i in range(args.users)]
+    backend = FakeSheetsBackend(
+        balance_rows(users),
+        history_rows(users, args.history_rows, args.seed),
+        latency=args.sheets_latency,
+        error_rate=args.sheets_error_rate,
+        seed=args.seed
+    )
+    bot = FakeBot(latency=args.bot_latency, retry_after_rate=args.bot_429_rate, seed=args.seed)
+    application = leave_bot.build_application(bot=bot, authorize=lambda: backend)
+    recorder = Recorder(application)
+    factory = UpdateFactory(bot)
+
+    await application.initialize()
+    start = time.perf_counter()
+    await leave_bot.post_init(application)
+    startup_seconds = time.perf_counter() - start
+    # Indexes load in the background; let them finish so scenarios measure steady state
+    await leave_bot.warm_up_task
+    warm_up_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    await SCENARIOS[name](leave_bot, recorder, factory, args)
+    elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    await leave_bot.post_stop(application)
+    drain_seconds = time.perf_counter() - start
+    await application.shutdown()
+    await leave_bot.post_shutdown(application)
+
+    updates = sum(len(values) for values in recorder.latencies.values())
+    return {
+        'scenario': name,
+        'settings': {
+            key: getattr(args, key) for key in (
+                'users', 'history_rows', 'sheets_latency', 'sheets_error_rate',
+                'bot_latency', 'bot_429_rate', 'telegram_limits'
+            )
+        },
+        'updates': updates,
+        'seconds': round(elapsed, 4),
+        'updates_per_second': round(updates / elapsed, 1) if elapsed else None,
+        'startup_seconds': round(startup_seconds, 4),
+        'warm_up_seconds': round(warm_up_seconds, 4),
+        'drain_seconds': round(drain_seconds, 4),
+        'steps': {
+            step: {
+                'count': len(values),
+                'p50': round(percentile(values, 0.50), 4),
+                'p95': round(percentile(values, 0.95), 4),
+                'p99': round(percentile(values, 0.99), 4)
+            }
+            for step, values in recorder.latencies.items()
+        },
+        'sheets_calls': dict(backend.calls),
+        'sheets_errors': dict(backend.errors),
+        'telegram_calls': dict(bot.calls),
+        'telegram_retry_afters': dict(bot.retry_afters),
+        'handler_errors': dict(recorder.errors)
+    }
+
+def report(result, previous):
+    """Print a result, flagging regressions against the previous comparable run"""
+    print(f"\n== {result['scenario']} ({result['updates']} updates in {result['seconds']}s, "
+          f"{result['updates_per_second']} updates/s) ==")
+    print(f"startup {result['startup_seconds']}s, warm-up {result['warm_up_seconds']}s, "
+          f"drain {result['drain_seconds']}s")
+    print(f"{'step':<22}{'count':>7}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for step, stats in result['steps'].items():
+        flag = ''
+        if previous and step in previous['steps']:
+            before = previous['steps'][step]['p95']
+            if before and stats['p95'] > before * (1 + REGRESSION_THRESHOLD):
+                flag = f"  REGRESSION (p95 was {before})"
+        print(f"{step:<22}{stats['count']:>7}{stats['p50']:>10}{stats['p95']:>10}{stats['p99']:>10}{flag}")
+    print("Sheets calls: " + ", ".join(f"{op}={n}" for op, n in sorted(result['sheets_calls'].items())))
+    if previous:
+        before = sum(previous['sheets_calls'].values())
+        after = sum(result['sheets_calls'].values())
+        if before and after > before * (1 + REGRESSION_THRESHOLD):
+            print(f"REGRESSION: {after} Sheets calls, previous run made {before}")
+    if result['sheets_errors']:
+        print("Sheets 429s injected: " + ", ".join(f"{op}={n}" for op, n in sorted(result['sheets_errors'].items())))
+    print("Telegram calls: " + ", ".join(f"{m}={n}" for m, n in sorted(result['telegram_calls'].items())))
+    if result['handler_errors']:
+        print("Handler errors: " + ", ".join(f"{e}={n}" for e, n in sorted(result['handler_errors'].items())))
+
+def load_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+def previous_result(history, result):
+    for earlier in reversed(history):
+        if earlier['scenario'] == result['scenario'] and earlier['settings'] == result['settings']:
+            return earlier
+    return None
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline load test for the leave bot")
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help=f"scenarios to run: {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--history-rows', type=int, default=10000)
+    parser.add_argument('--sheets-latency', type=float, default=0.2, help="seconds per Sheets API call")
+    parser.add_argument('--sheets-error-rate', type=float, default=0.0, help="chance of a 429 per Sheets call")
+    parser.add_argument('--bot-latency', type=float, default=0.05, help="seconds per Bot API call")
+    parser.add_argument('--bot-429-rate', type=float, default=0.0, help="chance of a 429 per Bot API call")
+    parser.add_argument('--telegram-limits', action='store_true',
+                        help="keep Telegram's real per-chat and global send limits")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--results', default=RESULTS_FILE, help="file results are appended to")
+    parser.add_argument('--no-save', action='store_true')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        sys.exit(f"Unknown scenario(s): {', '.join(sorted(unknown))}")
+    if args.child:
+        print(json.dumps(asyncio.run(run_scenario(args.child, args))))
+        return
+
+    history = load_results(args.results)
+    argv = sys.argv[1:] if argv is None else argv
+    for name in args.scenarios or SCENARIOS:
+        # Each scenario runs in a fresh interpreter, so no state leaks between them
+        child_argv = [a for a in argv if a not in SCENARIOS]
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), *child_argv, '--child', name],
+            stdout=subprocess.PIPE, check=True, text=True
+        )
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        result['recorded_at'] = datetime.now().isoformat(timespec='seconds')
+        report(result, previous_result(history, result))
+        history.append(result)
+
+    if not args.no_save:
+        with open(args.results, 'w') as f:
+            json.dump(history, f, indent=1)
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,49 @@
-# Rename this file to config.py and fill in your values
+# Rename this file to config.py and fill in your values.
+# Any setting can instead be set as a LEAVE_BOT_<NAME> environment variable.
 BOT_TOKEN = "your_bot_token_here"
 SUPERVISOR_GROUP_ID = "your_supervisor_group_id_here"
 DUTY_OPS_GROUP_ID = "your_duty_ops_group_id_here"
 SPREADSHEET_ID = "your_spreadsheet_id_here"
-CREDENTIALS_FILE = "path_to_your_credentials.json"
\ No newline at end of file
+CREDENTIALS_FILE = "path_to_your_credentials.json"
+
+# Optional: Google Sheets access
+SHEETS_MAX_WORKERS = 4  # threads used for blocking gspread calls
+SHEETS_TIMEOUTS = {"default": 20, "get_all_values": 60}  # seconds per operation
+SHEETS_TOKEN_REFRESH_INTERVAL = 600  # seconds between checks of the Sheets access token
+SHEETS_READ_QUOTA = 60  # Sheets read requests per minute allowed for the service account
+SHEETS_WRITE_QUOTA = 60  # Sheets write requests per minute allowed for the service account
+SHEETS_MAX_RETRIES = 5  # retries of a Sheets call rejected with 429 (or a server error, for reads)
+SHEETS_MAX_BACKOFF = 32  # longest wait in seconds between those retries
+BALANCE_ID_COLUMN = None  # column of Telegram IDs in sheet1 (1-based); None searches every column
+BALANCE_TEAM_COLUMN = None  # column of team names in sheet1 (1-based), used to group /report totals
+BALANCE_INDEX_TTL = 300  # seconds before the cached balance sheet is re-read
+HISTORY_REFRESH_INTERVAL = 900  # seconds between background re-reads of Leave History
+PENDING_DB_FILE = "pending_requests.db"  # SQLite file holding in-flight requests
+PENDING_REQUEST_MAX_AGE_DAYS = 14  # unanswered requests are dropped after this many days
+NOTIFY_MAX_RETRIES = 5  # retries for a Telegram notification before it is dropped
+LEDGER_DB_FILE = "ledger.db"  # local ledger of balances and approved leave
+LEDGER_SYNC_INTERVAL = 10  # seconds between pushes of ledger changes to Google Sheets
+REPORT_PAGE_ROWS = 1000  # Leave History rows read per request when building a /report
+ACCRUAL_HOURS = None  # hours credited to every balance each month; None disables accrual
+ACCRUAL_DAY = 1  # day of the month from which the accrual is credited
+ADJUSTMENTS_DIR = "adjustments"  # drop telegram_id,hours CSVs here; each file is applied once
+MAX_HOURS_PER_DAY = 8  # most hours of leave on one day; "weekdays" alone books this many
+HOLIDAYS_FILE = None  # e.g. "holidays.txt": one YYYY-MM-DD per line, skipped by "weekdays" hours
+
+# Optional: serving mode. Polling is the default; use webhook mode behind an ingress
+SERVE_MODE = "polling"  # or "webhook"
+WEBHOOK_URL = "https://bot.example.com/telegram"  # public URL Telegram posts updates to
+WEBHOOK_PATH = "telegram"
+WEBHOOK_LISTEN = "0.0.0.0"
+WEBHOOK_PORT = 8443
+WEBHOOK_SECRET_TOKEN = "a_long_random_string"  # required in webhook mode
+STATUS_LISTEN = "127.0.0.1"
+STATUS_PORT = None  # e.g. 8080 to serve GET /healthz and GET /metrics (Prometheus)
+MAX_CONCURRENT_UPDATES = 64  # updates handled at once (still one at a time per request/chat)
+SHARED_STATE_FILE = None  # SQLite file shared by several instances (see README); None runs one
+INSTANCE_ID = ""  # name of this instance in the leader lease; defaults to host:pid
+LEADER_LEASE_SECONDS = 30  # a stopped leader is replaced within this many seconds
+
+# Optional: administration and logging
+ADMIN_IDS = []  # Telegram user IDs allowed to use /stats and /report
+LOG_LEVEL = "INFO"
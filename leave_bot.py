@@ -1,82 +1,2286 @@
 import sys
 import os
+import asyncio
+import contextlib
+import contextvars
+import copy
+import csv
+import io
+import functools
+import glob
+import logging
+import pickle
+import random
+import re
+import socket
+import time
+import sqlite3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
 from telegram.ext import (
     Application, 
+    BaseUpdateProcessor,
     CommandHandler, 
     CallbackQueryHandler, 
     MessageHandler, 
     ContextTypes,
     ConversationHandler,
+    TypeHandler,
     filters
 )
-try:
-    from config import BOT_TOKEN, SUPERVISOR_GROUP_ID, DUTY_OPS_GROUP_ID, SPREADSHEET_ID, CREDENTIALS_FILE
-except ImportError:
-    print("Error: Cannot find config.py")
-    sys.exit(1)
-
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import json
+import argparse
+import runpy
+
+# Startup is timed from here, the earliest point this module controls
+started_at = time.monotonic()
+
+# Settings, overridden by load_config() from config.py and LEAVE_BOT_* environment variables
+BOT_TOKEN = ''
+SUPERVISOR_GROUP_ID = None
+DUTY_OPS_GROUP_ID = None
+SPREADSHEET_ID = ''
+CREDENTIALS_FILE = ''
+# Optional settings (see config.example.py)
+SHEETS_MAX_WORKERS = 4
+SHEETS_TIMEOUTS = {
+    'default': 20,
+    'get_all_values': 60,
+}
+# Seconds between checks that the Sheets access token is still valid
+SHEETS_TOKEN_REFRESH_INTERVAL = 600
+# Sheets API quotas in requests per minute (Google's default is 60 reads and 60 writes per
+# user per project); calls are paced to stay under them instead of being rejected with 429
+SHEETS_READ_QUOTA = 60
+SHEETS_WRITE_QUOTA = 60
+# Retries of a Sheets call rejected for quota or, for reads, by a server error
+SHEETS_MAX_RETRIES = 5
+# Longest wait between retries; the wait doubles from 1s with up to 1s of jitter
+SHEETS_MAX_BACKOFF = 32
+BALANCE_COLUMN = 4
+# Column holding Telegram IDs in sheet1; None matches any column, like worksheet.find()
+BALANCE_ID_COLUMN = None
+# Column holding team names in sheet1, used to group /report totals; None puts everyone in one team
+BALANCE_TEAM_COLUMN = None
+BALANCE_INDEX_TTL = 300
+# Minimum seconds between re-reads triggered by an unknown Telegram ID
+BALANCE_INDEX_MISS_REFRESH = 30
+# Seconds between full re-reads of Leave History to pick up rows edited by hand
+HISTORY_REFRESH_INTERVAL = 900
+PENDING_DB_FILE = 'pending_requests.db'
+# Pending requests nobody has acted on are dropped after this many days
+PENDING_REQUEST_MAX_AGE_DAYS = 14
+LEDGER_DB_FILE = 'ledger.db'
+# Seconds between pushes of ledger changes to Google Sheets (approvals also trigger one)
+LEDGER_SYNC_INTERVAL = 10
+# Most Leave History rows appended per sync batch
+LEDGER_SYNC_BATCH = 500
+# Hours credited to every balance each month, on or after ACCRUAL_DAY; None disables accrual
+ACCRUAL_HOURS = None
+ACCRUAL_DAY = 1
+# Directory of balance adjustment CSVs (telegram_id,hours), each applied once
+ADJUSTMENTS_DIR = 'adjustments'
+# Seconds between checks for due accrual and new adjustment files
+ADJUSTMENT_CHECK_INTERVAL = 3600
+# Leave History rows read per request when building a /report
+REPORT_PAGE_ROWS = 1000
+# Closed-month reports kept in memory
+REPORT_CACHE_MONTHS = 24
+# "polling" (default, for development) or "webhook" (behind an ingress)
+SERVE_MODE = 'polling'
+WEBHOOK_URL = ''
+WEBHOOK_PATH = 'telegram'
+WEBHOOK_LISTEN = '0.0.0.0'
+WEBHOOK_PORT = 8443
+WEBHOOK_SECRET_TOKEN = ''
+# Updates processed at once; updates for the same request or conversation still queue
+MAX_CONCURRENT_UPDATES = 64
+# How many finished request IDs to remember for answering repeated button presses
+PROCESSED_REQUESTS_KEPT = 1000
+# Most requests shown in one /pending list, and how many lists keep working buttons
+PENDING_LIST_LIMIT = 50
+PENDING_LISTS_KEPT = 100
+# Most lines in a per-day breakdown; runs of identical days share a line, and Telegram
+# rejects messages over 4096 characters
+MAX_BREAKDOWN_LINES = 31
+# Most hours of leave on one day; "weekdays" on its own means this many per weekday
+MAX_HOURS_PER_DAY = 8
+# Public holidays, one YYYY-MM-DD per line; "weekdays" hours skip them. Re-read when it changes
+HOLIDAYS_FILE = None
+# Telegram user IDs allowed to use admin commands such as /stats
+ADMIN_IDS = set()
+LOG_LEVEL = 'INFO'
+# Local HTTP port for /healthz and /metrics; None disables it
+STATUS_LISTEN = '127.0.0.1'
+STATUS_PORT = None
+# Telegram flood limits: ~30 messages/s overall, 1/s per private chat, 20/min per group
+TELEGRAM_GLOBAL_RATE = 30
+PRIVATE_CHAT_INTERVAL = 1.0
+GROUP_CHAT_INTERVAL = 3.0
+NOTIFY_MAX_RETRIES = 5
+# SQLite file through which several instances behind one webhook share conversations,
+# /pending lists and the leader lease (see README); None runs a single instance
+SHARED_STATE_FILE = None
+# Name of this instance in the leader lease; defaults to host:pid
+INSTANCE_ID = ''
+# Seconds the leader keeps the background jobs without renewing its lease
+LEADER_LEASE_SECONDS = 30
+
+REQUIRED_SETTINGS = ('BOT_TOKEN', 'SUPERVISOR_GROUP_ID', 'DUTY_OPS_GROUP_ID', 'SPREADSHEET_ID', 'CREDENTIALS_FILE')
+SETTINGS = [name for name in list(globals()) if name.isupper() and name != 'REQUIRED_SETTINGS']
+ENV_PREFIX = 'LEAVE_BOT_'
+
+class ConfigError(Exception):
+    """Raised when the bot's configuration is missing or invalid"""
+
+def load_config(config_file=None, environ=None, **overrides):
+    """Apply settings from config_file, then LEAVE_BOT_<NAME> variables in environ, then overrides
+
+    Called once when the app starts; importing this module never reads configuration.
+    """
+    values = {}
+    if config_file and os.path.exists(config_file):
+        namespace = runpy.run_path(config_file)
+        values.update((name, namespace[name]) for name in SETTINGS if name in namespace)
+    for name in SETTINGS:
+        raw = (environ or {}).get(ENV_PREFIX + name)
+        if raw is None:
+            continue
+        if isinstance(globals()[name], str):
+            values[name] = raw
+        else:
+            # Numbers, None, lists and dicts are written as JSON: LEAVE_BOT_ADMIN_IDS='[123, 456]'
+            try:
+                values[name] = json.loads(raw)
+            except ValueError:
+                values[name] = raw
+    values.update(overrides)
+    unknown = set(values) - set(SETTINGS)
+    if unknown:
+        raise ConfigError(f"Unknown settings: {', '.join(sorted(unknown))}")
+    if 'SHEETS_TIMEOUTS' in values:
+        values['SHEETS_TIMEOUTS'] = {**SHEETS_TIMEOUTS, **values['SHEETS_TIMEOUTS']}
+    if 'ADMIN_IDS' in values:
+        values['ADMIN_IDS'] = {int(admin_id) for admin_id in values['ADMIN_IDS']}
+    missing = [name for name in REQUIRED_SETTINGS if values.get(name, globals()[name]) in (None, '')]
+    if missing:
+        raise ConfigError(
+            f"Missing settings: {', '.join(missing)}. "
+            f"Set them in {config_file or 'config.py'} or as {ENV_PREFIX}<NAME> environment variables."
+        )
+    globals().update(values)
+
+logger = logging.getLogger("leave_bot")
+
+# Request ID of the request being handled, added to every log line
+current_request_id = contextvars.ContextVar('current_request_id', default='-')
+# Handler whose work is running, used to attribute Sheets calls
+current_handler = contextvars.ContextVar('current_handler', default='background')
+# user_data as load_user_state() found it, so save_user_state() only writes changes
+loaded_user_data = contextvars.ContextVar('loaded_user_data', default=None)
+
+class RequestIdFilter(logging.Filter):
+    """Adds the current request ID to log records as %(request_id)s"""
+    def filter(self, record):
+        record.request_id = current_request_id.get()
+        return True
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Metrics:
+    """In-process counters, histograms and gauges, rendered in Prometheus text format"""
+    def __init__(self):
+        self.help = {}
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def inc(self, name, labels=(), amount=1):
+        key = (name, tuple(labels))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, labels=()):
+        key = (name, tuple(labels))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [[0] * len(LATENCY_BUCKETS), 0.0, 0]
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    def gauge(self, name, func, description):
+        """Register a gauge whose value is read from func() at scrape time"""
+        self.gauges[name] = func
+        self.help[name] = description
+
+    def describe(self, name, description):
+        self.help[name] = description
+
+    def quantile(self, name, labels, q):
+        """Approximate quantile of a histogram: the upper bound of the bucket it falls in"""
+        buckets, _, count = self.histograms[(name, tuple(labels))]
+        for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+            if bucket_count >= q * count:
+                return bound
+        return float('inf')
+
+    def render(self):
+        """Prometheus text exposition of every metric"""
+        lines = []
+        def header(name, kind):
+            if name in self.help:
+                lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+        def label_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+        seen = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in seen:
+                header(name, 'counter')
+                seen.add(name)
+            lines.append(f"{name}{label_text(labels)} {value}")
+        for (name, labels), (buckets, total, count) in sorted(self.histograms.items()):
+            if name not in seen:
+                header(name, 'histogram')
+                seen.add(name)
+            for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+                lines.append(f"{name}_bucket{label_text(labels, [('le', bound)])} {bucket_count}")
+            lines.append(f"{name}_bucket{label_text(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{label_text(labels)} {total}")
+            lines.append(f"{name}_count{label_text(labels)} {count}")
+        for name, func in sorted(self.gauges.items()):
+            header(name, 'gauge')
+            lines.append(f"{name} {func()}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+metrics.describe('leave_bot_handler_seconds', 'Time spent in each Telegram handler')
+metrics.describe('leave_bot_sheets_calls_total', 'Google Sheets API calls by operation, handler and outcome')
+metrics.describe('leave_bot_sheets_seconds', 'Duration of Google Sheets API calls by operation')
+metrics.describe('leave_bot_sheets_retries_total', 'Google Sheets calls retried by operation and HTTP status')
+metrics.describe('leave_bot_sheets_shared_reads_total', 'Google Sheets reads answered by an identical read in flight')
+metrics.describe('leave_bot_messages_sent_total', 'Telegram messages sent from the notification queue')
+metrics.describe('leave_bot_send_failures_total', 'Failed Telegram send attempts by reason')
+metrics.describe('leave_bot_balance_adjustments_total', 'Balances credited by accrual or adjustment files')
+
+def timed(handler):
+    """Record a handler's latency and attribute the Sheets calls it makes to it"""
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        token = current_handler.set(handler.__name__)
+        start = time.perf_counter()
+        try:
+            return await handler(update, context)
+        finally:
+            metrics.observe(
+                'leave_bot_handler_seconds', time.perf_counter() - start, [('handler', handler.__name__)]
+            )
+            current_handler.reset(token)
+    return wrapper
 
 # States for conversation
 DATES = 0
 HOURS = 1
 REMARKS = 2
 
-# Initialize Google Sheets API
-scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-creds = ServiceAccountCredentials.from_json_keyfile_name(CREDENTIALS_FILE, scope)
-client = gspread.authorize(creds)
+def authorize_sheets():
+    """Authorize a gspread client with the service account in CREDENTIALS_FILE (blocking)"""
+    # Imported here: gspread and oauth2client pull in google-auth and requests, which is slow
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
+    scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+    creds = ServiceAccountCredentials.from_json_keyfile_name(CREDENTIALS_FILE, scope)
+    return gspread.authorize(creds)
+
+class SheetsTimeoutError(Exception):
+    """Raised when a Google Sheets call does not finish within its timeout"""
+
+# Sheets calls that count against the write quota; authorize and refresh_token count against none
+SHEETS_WRITE_OPERATIONS = {'batch_update'}
+SHEETS_UNMETERED_OPERATIONS = {'authorize', 'refresh_token'}
+
+def sheets_error_status(error):
+    """HTTP status of a failed gspread call, or None if it never got a response"""
+    return getattr(getattr(error, 'response', None), 'status_code', None)
+
+class SheetsThrottle:
+    """Token bucket pacing calls under a per-minute quota, slowing down when Google pushes back
+
+    Google counts requests per minute, so up to half a minute's quota may go out at
+    once. A 429 halves the rate and drops any saved-up burst; each success wins back
+    a fiftieth of the quota, so the rate settles just under what Google is allowing.
+    """
+    def __init__(self, quota):
+        self.quota = quota
+        self.rate = quota
+        self.capacity = max(1, quota / 2)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate / 60)
+        self.updated = now
+        # Reserve a token now, possibly going into debt, then wait until it is paid off
+        self.tokens -= 1
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens * 60 / self.rate)
+
+    def throttle(self):
+        self.rate = max(self.quota / 10, self.rate / 2)
+        self.tokens = min(self.tokens, 0)
+
+    def recover(self):
+        self.rate = min(self.quota, self.rate + self.quota / 50)
+
+def cell_data(value):
+    """CellData for a batch_update request; strings are stored as-is, like append_row"""
+    if value is None:
+        return {}
+    if isinstance(value, bool):
+        return {'userEnteredValue': {'boolValue': value}}
+    if isinstance(value, (int, float)):
+        return {'userEnteredValue': {'numberValue': value}}
+    return {'userEnteredValue': {'stringValue': str(value)}}
+
+class SheetsGateway:
+    """Runs blocking gspread calls on a bounded thread pool so handlers never block the event loop
+
+    Calls are paced under the read and write quotas and retried with backoff when
+    Google answers 429. Identical reads in flight are shared, and row ranges of a
+    worksheet asked for while a read of it is in flight go out as one batch_get.
+    """
+    def __init__(self, authorize, max_workers, timeouts, read_quota=60, write_quota=60, max_retries=5):
+        self.authorize = authorize
+        self.client = None
+        self.timeouts = timeouts
+        self.read_throttle = SheetsThrottle(read_quota)
+        self.write_throttle = SheetsThrottle(write_quota)
+        self.max_retries = max_retries
+        self.in_flight = {}
+        self.queued_ranges = {}
+        self.batch_tasks = set()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sheets")
+        self.spreadsheet = None
+        self.worksheets = {}
+        self.client_lock = asyncio.Lock()
+        self.open_lock = asyncio.Lock()
+
+    async def run(self, operation, func, *args, **kwargs):
+        """Run func(*args, **kwargs) in the pool within the quota, retrying rejected calls
+
+        429s are retried for every call; server errors only for reads, since a write
+        that failed on Google's side may still have appended its rows.
+        """
+        if operation in SHEETS_UNMETERED_OPERATIONS:
+            return await self.call(operation, func, *args, **kwargs)
+        throttle = self.write_throttle if operation in SHEETS_WRITE_OPERATIONS else self.read_throttle
+        for attempt in range(self.max_retries + 1):
+            await throttle.acquire()
+            try:
+                result = await self.call(operation, func, *args, **kwargs)
+            except Exception as e:
+                status = sheets_error_status(e)
+                if status == 429:
+                    throttle.throttle()
+                elif status is None or status < 500 or throttle is self.write_throttle:
+                    raise
+                if attempt == self.max_retries:
+                    raise
+                delay = min(2 ** attempt + random.random(), SHEETS_MAX_BACKOFF)
+                metrics.inc('leave_bot_sheets_retries_total', [('operation', operation), ('status', status)])
+                logger.warning("Google Sheets %s failed with HTTP %s, retrying in %.1fs", operation, status, delay)
+                await asyncio.sleep(delay)
+            else:
+                throttle.recover()
+                return result
+
+    async def call(self, operation, func, *args, **kwargs):
+        """Run func(*args, **kwargs) in the pool once, giving up after the operation's timeout"""
+        timeout = self.timeouts.get(operation, self.timeouts['default'])
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+        start = time.perf_counter()
+        outcome = 'ok'
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            outcome = 'timeout'
+            # The worker thread keeps running until gspread returns, but the handler moves on
+            raise SheetsTimeoutError(f"Google Sheets {operation} timed out after {timeout}s")
+        except Exception as e:
+            outcome = 'quota' if sheets_error_status(e) == 429 else 'error'
+            raise
+        finally:
+            metrics.inc('leave_bot_sheets_calls_total', [
+                ('operation', operation), ('handler', current_handler.get()), ('outcome', outcome)
+            ])
+            metrics.observe('leave_bot_sheets_seconds', time.perf_counter() - start, [('operation', operation)])
+
+    async def get_client(self):
+        """Return the gspread client, authorizing on first use"""
+        if self.client is None:
+            async with self.client_lock:
+                if self.client is None:
+                    self.client = await self.run('authorize', self.authorize)
+        return self.client
+
+    async def refresh_token(self):
+        """Refresh the access token before it expires, so no handler waits for it
+
+        A token that is missing or has less than two check intervals left is refreshed
+        here on the pool; otherwise google-auth would refresh it inside the next call.
+        """
+        client = await self.get_client()
+        credentials = getattr(getattr(client, 'http_client', client), 'auth', None)
+        if credentials is None or not hasattr(credentials, 'refresh'):
+            return
+        expiry = getattr(credentials, 'expiry', None)
+        margin = timedelta(seconds=2 * SHEETS_TOKEN_REFRESH_INTERVAL)
+        # google-auth keeps expiry as a naive UTC datetime
+        if credentials.valid and expiry is not None and expiry - datetime.utcnow() > margin:
+            return
+        from google.auth.transport.requests import Request
+        await self.run('refresh_token', credentials.refresh, Request())
+        logger.info("Refreshed Google Sheets access token")
+
+    async def worksheet(self, title):
+        """Return a cached Worksheet, fetching spreadsheet metadata only on first use"""
+        if title in self.worksheets:
+            return self.worksheets[title]
+        async with self.open_lock:
+            if self.spreadsheet is None:
+                client = await self.get_client()
+                self.spreadsheet = await self.run('open_by_key', client.open_by_key, SPREADSHEET_ID)
+            if title not in self.worksheets:
+                if title is None:
+                    self.worksheets[title] = await self.run('worksheet', self.spreadsheet.get_worksheet, 0)
+                else:
+                    self.worksheets[title] = await self.run('worksheet', self.spreadsheet.worksheet, title)
+            return self.worksheets[title]
+
+    async def balance_sheet(self):
+        return await self.worksheet(None)
+
+    async def history_sheet(self):
+        return await self.worksheet("Leave History")
+
+    def forget_worksheets(self):
+        """Drop cached handles, e.g. after a tab was renamed or recreated"""
+        self.spreadsheet = None
+        self.worksheets = {}
+
+    async def write_batch(self, balance_updates, history_rows):
+        """Set balances and append Leave History rows in one atomic batch_update
+
+        balance_updates is a list of (row, balance) pairs for sheet1. Consecutive rows
+        are written as one range, so a full-column update is a single updateCells.
+        """
+        balance_sheet = await self.balance_sheet()
+        history_sheet = await self.history_sheet()
+        runs = []
+        for row, balance in sorted(dict(balance_updates).items()):
+            if runs and runs[-1][0] + len(runs[-1][1]) == row:
+                runs[-1][1].append(balance)
+            else:
+                runs.append((row, [balance]))
+        requests = [
+            {
+                'updateCells': {
+                    'range': {
+                        'sheetId': balance_sheet.id,
+                        'startRowIndex': first_row - 1,
+                        'endRowIndex': first_row - 1 + len(balances),
+                        'startColumnIndex': BALANCE_COLUMN - 1,
+                        'endColumnIndex': BALANCE_COLUMN
+                    },
+                    'rows': [{'values': [cell_data(balance)]} for balance in balances],
+                    'fields': 'userEnteredValue'
+                }
+            }
+            for first_row, balances in runs
+        ]
+        if history_rows:
+            requests.append({
+                'appendCells': {
+                    'sheetId': history_sheet.id,
+                    'rows': [{'values': [cell_data(value) for value in values]} for values in history_rows],
+                    'fields': 'userEnteredValue'
+                }
+            })
+        return await self.run('batch_update', self.spreadsheet.batch_update, {'requests': requests})
+
+    async def shared_read(self, key, operation, read):
+        """Await read(), or the identical read already in flight under key
+
+        Every caller gets the same result object, so none of them may modify it.
+        """
+        call = self.in_flight.get(key)
+        if call is None:
+            call = self.in_flight[key] = asyncio.ensure_future(read())
+            call.add_done_callback(functools.partial(self._read_done, key))
+        else:
+            metrics.inc('leave_bot_sheets_shared_reads_total', [('operation', operation)])
+        # Shielded, so a caller that is cancelled or times out does not cancel the others' read
+        return await asyncio.shield(call)
+
+    def _read_done(self, key, call):
+        del self.in_flight[key]
+        if not call.cancelled():
+            # Retrieved here so an error nobody is still waiting for is not logged as unhandled
+            call.exception()
+
+    async def get_all_values(self, worksheet):
+        return await self.shared_read(
+            ('get_all_values', worksheet.id), 'get_all_values',
+            lambda: self.run('get_all_values', worksheet.get_all_values)
+        )
+
+    async def get_rows(self, worksheet, first_row, last_row):
+        """Values of rows first_row..last_row (1-based, inclusive); trailing empty rows are omitted"""
+        range_name = f"{first_row}:{last_row}"
+        return await self.shared_read(
+            ('get_rows', worksheet.id, range_name), 'get_rows', lambda: self._read_range(worksheet, range_name)
+        )
+
+    async def _read_range(self, worksheet, range_name):
+        """Read a range now if the worksheet is idle, else queue it for the next batch_get
+
+        Waiting for the read in flight is the batching window, so a lone read is
+        never delayed and a burst costs one request per round trip.
+        """
+        queued = self.queued_ranges.get(worksheet.id)
+        if queued is not None:
+            future = asyncio.get_running_loop().create_future()
+            queued.append((range_name, future))
+            return await future
+        self.queued_ranges[worksheet.id] = []
+        try:
+            return await self.run('get_rows', worksheet.get, range_name)
+        finally:
+            self._start_batch(worksheet)
+
+    def _start_batch(self, worksheet):
+        if not self.queued_ranges[worksheet.id]:
+            del self.queued_ranges[worksheet.id]
+            return
+        task = asyncio.create_task(self._read_batches(worksheet))
+        self.batch_tasks.add(task)
+        task.add_done_callback(self.batch_tasks.discard)
+
+    async def _read_batches(self, worksheet):
+        queued = self.queued_ranges[worksheet.id]
+        try:
+            while queued:
+                batch = queued[:]
+                queued.clear()
+                try:
+                    results = await self.run('batch_get', worksheet.batch_get, [range_name for range_name, _ in batch])
+                except Exception as e:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    for (_, future), values in zip(batch, results):
+                        if not future.done():
+                            future.set_result(values)
+        finally:
+            # No await between the last check of queued and here, so no range is stranded
+            del self.queued_ranges[worksheet.id]
+            for _, future in queued:
+                future.cancel()
+
+    def shutdown(self):
+        for task in self.batch_tasks:
+            task.cancel()
+        self.executor.shutdown(wait=False)
+
+
+class Ledger:
+    """Local SQLite ledger of balances and approved leave, the bot's system of record
+
+    Approvals commit here and return immediately; LedgerSync pushes the changes to
+    sheet1 and Leave History in the background. Balances read back from sheet1 are
+    stored here too, unless a local change has not been pushed yet, so edits made by
+    hand in the sheet are reconciled into the ledger.
+    """
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS balances ("
+            "telegram_id TEXT PRIMARY KEY, sheet_row INTEGER NOT NULL, balance REAL NOT NULL, "
+            "version INTEGER NOT NULL DEFAULT 0, synced_version INTEGER NOT NULL DEFAULT 0)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, request_id TEXT UNIQUE NOT NULL, "
+            "telegram_id TEXT NOT NULL, row_values TEXT NOT NULL, synced INTEGER NOT NULL DEFAULT 0)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS adjustments ("
+            "batch TEXT NOT NULL, telegram_id TEXT NOT NULL, hours REAL NOT NULL, balance REAL NOT NULL, "
+            "applied_at REAL NOT NULL, PRIMARY KEY (batch, telegram_id))"
+        )
+        self.conn.commit()
+
+    def balances(self):
+        """Return {telegram_id: [row, balance]} for every balance in the ledger"""
+        rows = self.conn.execute("SELECT telegram_id, sheet_row, balance FROM balances")
+        return {telegram_id: [row, balance] for telegram_id, row, balance in rows}
+
+    def unsynced_balances(self):
+        """Return {telegram_id: [row, balance]} for local changes not yet in the sheet"""
+        rows = self.conn.execute(
+            "SELECT telegram_id, sheet_row, balance FROM balances WHERE version > synced_version"
+        )
+        return {telegram_id: [row, balance] for telegram_id, row, balance in rows}
+
+    def snapshot_balances(self, entries, new_only=False):
+        """Store rows and balances read from sheet1, keeping balances not pushed yet
+
+        Rows are always taken from the read: rows inserted above someone by hand move
+        their balance down, and a change waiting to be pushed must go to the new row.
+        With new_only, only IDs the ledger does not have yet are stored.
+        """
+        rows = []
+        for telegram_id, (row, balance) in entries.items():
+            try:
+                rows.append((telegram_id, row, float(balance)))
+            except ValueError:
+                continue
+        if new_only:
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT INTO balances (telegram_id, sheet_row, balance) VALUES (?, ?, ?) "
+                    "ON CONFLICT(telegram_id) DO NOTHING",
+                    rows
+                )
+            return
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO balances (telegram_id, sheet_row, balance) VALUES (?, ?, ?) "
+                "ON CONFLICT(telegram_id) DO UPDATE SET sheet_row = excluded.sheet_row, "
+                "balance = CASE WHEN version = synced_version THEN excluded.balance ELSE balance END",
+                rows
+            )
+
+    def balance(self, telegram_id):
+        """The ledger's balance for a Telegram ID, or None if it has none"""
+        found = self.conn.execute(
+            "SELECT balance FROM balances WHERE telegram_id = ?", (str(telegram_id),)
+        ).fetchone()
+        return found[0] if found else None
+
+    def _set_balance(self, telegram_id, row, balance):
+        self.conn.execute(
+            "INSERT INTO balances (telegram_id, sheet_row, balance, version) VALUES (?, ?, ?, 1) "
+            "ON CONFLICT(telegram_id) DO UPDATE SET "
+            "sheet_row = excluded.sheet_row, balance = excluded.balance, version = version + 1",
+            (str(telegram_id), row, balance)
+        )
+        # Other IDs on the same row see the new balance too; only this one is pushed
+        self.conn.execute(
+            "UPDATE balances SET balance = ? WHERE sheet_row = ? AND telegram_id != ?",
+            (balance, row, str(telegram_id))
+        )
+
+    def _add_to_balance(self, telegram_id, row, hours):
+        """Add hours to a balance in the current transaction and return the new balance
+
+        The balance is read inside the transaction, not taken from the caller, so a change
+        committed meanwhile by another process sharing the ledger is never overwritten.
+        """
+        balance = self.balance(telegram_id)
+        if balance is None:
+            raise ValueError(f"No balance recorded for Telegram ID {telegram_id}")
+        balance += hours
+        self._set_balance(telegram_id, row, balance)
+        return balance
+
+    def applied_adjustments(self, batch):
+        """Telegram IDs a balance adjustment batch has already been applied to"""
+        rows = self.conn.execute("SELECT telegram_id FROM adjustments WHERE batch = ?", (batch,))
+        return {telegram_id for (telegram_id,) in rows}
+
+    def record_adjustments(self, batch, changes):
+        """Atomically credit balances and record them as applied for batch
+
+        changes is a list of (telegram_id, row, hours). Returns the new balances, in order.
+        """
+        now = time.time()
+        balances = []
+        with self.conn:
+            # Take the write lock before reading balances, so no other process changes them in between
+            self.conn.execute("BEGIN IMMEDIATE")
+            for telegram_id, row, hours in changes:
+                balance = self._add_to_balance(telegram_id, row, hours)
+                self.conn.execute(
+                    "INSERT INTO adjustments (batch, telegram_id, hours, balance, applied_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (batch, str(telegram_id), hours, balance, now)
+                )
+                balances.append(balance)
+        return balances
+
+    def record_approvals(self, approvals):
+        """Atomically deduct approved hours and log Leave History rows for approvals
+
+        approvals is a list of (telegram_id, row, hours, request_id, values), applied
+        in order in one transaction. Returns the new balance or the exception for each,
+        in order; an approval that fails is rolled back on its own and the rest commit.
+        """
+        results = []
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            for telegram_id, row, hours, request_id, values in approvals:
+                self.conn.execute("SAVEPOINT approval")
+                try:
+                    balance = self._add_to_balance(telegram_id, row, -hours)
+                    self.conn.execute(
+                        "INSERT INTO history (request_id, telegram_id, row_values) VALUES (?, ?, ?)",
+                        (request_id, str(telegram_id), json.dumps(values))
+                    )
+                except (ValueError, sqlite3.IntegrityError) as e:
+                    self.conn.execute("ROLLBACK TO approval")
+                    results.append(e)
+                else:
+                    results.append(balance)
+                self.conn.execute("RELEASE approval")
+        return results
+
+    def pending_changes(self, limit):
+        """Return (balances, history) not yet pushed to the sheet
+
+        balances is a list of (telegram_id, row, balance, version) and history a list of
+        (seq, request_id, values), oldest first.
+        """
+        balances = self.conn.execute(
+            "SELECT telegram_id, sheet_row, balance, version FROM balances "
+            "WHERE version > synced_version"
+        ).fetchall()
+        history = [
+            (seq, request_id, json.loads(values)) for seq, request_id, values in self.conn.execute(
+                "SELECT seq, request_id, row_values FROM history WHERE synced = 0 ORDER BY seq LIMIT ?",
+                (limit,)
+            )
+        ]
+        return balances, history
+
+    def mark_synced(self, balances, history_seqs):
+        """Mark pushed changes; a balance changed again since the push stays unsynced"""
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE balances SET synced_version = ? WHERE telegram_id = ? AND synced_version < ?",
+                [(version, telegram_id, version) for telegram_id, _, _, version in balances]
+            )
+            self.conn.executemany(
+                "UPDATE history SET synced = 1 WHERE seq = ?", [(seq,) for seq in history_seqs]
+            )
+
+    def unsynced_count(self):
+        """Number of balance and history changes waiting to be pushed"""
+        (balances,) = self.conn.execute(
+            "SELECT COUNT(*) FROM balances WHERE version > synced_version"
+        ).fetchone()
+        (history,) = self.conn.execute("SELECT COUNT(*) FROM history WHERE synced = 0").fetchone()
+        return balances + history
+
+    def unsynced_history(self):
+        """Return (telegram_id, values) for approvals not yet appended to the sheet"""
+        rows = self.conn.execute(
+            "SELECT telegram_id, row_values FROM history WHERE synced = 0 ORDER BY seq"
+        )
+        return [(telegram_id, json.loads(values)) for telegram_id, values in rows]
+
+    def approval(self, request_id):
+        """The Leave History row logged when request_id was approved, or None if it was not"""
+        found = self.conn.execute(
+            "SELECT row_values FROM history WHERE request_id = ?", (request_id,)
+        ).fetchone()
+        return json.loads(found[0]) if found else None
+
+    def last_history_seq(self):
+        (seq,) = self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM history").fetchone()
+        return seq
+
+    def history_since(self, seq):
+        """Return (seq, telegram_id, values) for approvals logged after seq, by any process"""
+        rows = self.conn.execute(
+            "SELECT seq, telegram_id, row_values FROM history WHERE seq > ? ORDER BY seq", (seq,)
+        )
+        return [(seq, telegram_id, json.loads(values)) for seq, telegram_id, values in rows]
+
+    def close(self):
+        self.conn.close()
+
+
+def balance_row_ids(row):
+    """Telegram IDs found in a sheet1 row"""
+    if BALANCE_ID_COLUMN is not None:
+        ids = row[BALANCE_ID_COLUMN - 1:BALANCE_ID_COLUMN]
+    else:
+        # Like worksheet.find(), but only numeric cells outside the balance column
+        ids = [value for col, value in enumerate(row, start=1)
+               if col != BALANCE_COLUMN and str(value).strip().isdigit()]
+    return [str(value).strip() for value in ids]
+
+class BalanceIndex:
+    """In-memory Telegram ID -> (row, balance) index built from one bulk read of sheet1
+
+    Starts from the ledger, so lookups never wait on Sheets once anything is known.
+    Rows are re-read in the background when the index is older than BALANCE_INDEX_TTL,
+    and inline when an unknown ID is looked up (a row was probably added by hand).
+    Local changes the sheet has not received yet always win over what was read, and
+    balances are read back from the ledger, which other instances may be writing too.
+    Only the leader, which is also the only instance pushing, stores what it read in
+    the ledger; elsewhere a read could predate a push and undo it after mark_synced.
+    """
+    def __init__(self, gateway, ledger, ttl, leader):
+        self.gateway = gateway
+        self.ledger = ledger
+        self.ttl = ttl
+        self.leader = leader
+        self.entries = {}
+        self.loaded_at = None
+        self.lock = asyncio.Lock()
+        self.refresh_task = None
+
+    def is_fresh(self):
+        return self.loaded_at is not None and time.monotonic() - self.loaded_at < self.ttl
+
+    def invalidate(self):
+        self.loaded_at = None
+
+    def load_ledger(self):
+        """Serve balances from the ledger until the sheet has been read"""
+        self.entries = self.ledger.balances()
+
+    async def refresh(self):
+        """Rebuild the index from a single get_all_values() call"""
+        async with self.lock:
+            worksheet = await self.gateway.balance_sheet()
+            values = await self.gateway.get_all_values(worksheet)
+            entries = {}
+            for row_number, row in enumerate(values, start=1):
+                balance = row[BALANCE_COLUMN - 1] if len(row) >= BALANCE_COLUMN else ''
+                # IDs on the same row share one entry, so a change made through any of them is seen by all
+                entry = [row_number, balance]
+                for telegram_id in balance_row_ids(row):
+                    # First match wins, the same as worksheet.find()
+                    entries.setdefault(telegram_id, entry)
+            # Others only add people the ledger does not know yet, so they can be approved
+            self.ledger.snapshot_balances(entries, new_only=not self.leader.is_leader)
+            # The row just read stands; only the balance of a change not pushed yet wins
+            for telegram_id, (row, balance) in self.ledger.unsynced_balances().items():
+                entry = entries.get(telegram_id)
+                if entry is not None:
+                    entry[1] = balance
+                else:
+                    entries[telegram_id] = [row, balance]
+            self.entries = entries
+            self.loaded_at = time.monotonic()
+
+    async def _background_refresh(self):
+        try:
+            await self.refresh()
+        except Exception as e:
+            logger.warning("Error refreshing leave balances: %s", e)
+        finally:
+            self.refresh_task = None
+
+    async def lookup(self, telegram_id):
+        """Return (row, balance) for a Telegram ID, or None if it is not in the sheet"""
+        if self.loaded_at is None and not self.entries:
+            await self.refresh()
+        elif not self.is_fresh() and self.refresh_task is None:
+            self.refresh_task = asyncio.create_task(self._background_refresh())
+        entry = self.entries.get(str(telegram_id))
+        if entry is None and (self.loaded_at is None or
+                              time.monotonic() - self.loaded_at >= BALANCE_INDEX_MISS_REFRESH):
+            await self.refresh()
+            entry = self.entries.get(str(telegram_id))
+        if entry is None:
+            return None
+        row, balance = entry
+        ledger_balance = self.ledger.balance(telegram_id)
+        return row, float(balance if ledger_balance is None else ledger_balance)
+
+    def set_balance(self, telegram_id, balance):
+        """Record a balance the bot has just committed"""
+        entry = self.entries.get(str(telegram_id))
+        if entry is not None:
+            entry[1] = balance
+
+
+def history_record(telegram_id, values):
+    """Leave History record, keyed like the sheet's header, from a row the bot writes"""
+    return {
+        'Telegram ID': str(telegram_id),
+        'Timestamp': values[0],
+        'Start Date': values[3],
+        'End Date': values[4],
+        'Hours': values[5],
+        'Total Hours': values[6],
+        'Remarks': values[7],
+        'Request ID': values[8]
+    }
+
+def history_telegram_id(record):
+    """Telegram ID of a Leave History record"""
+    telegram_id = str(record.get('Telegram ID', '')).strip()
+    if not telegram_id:
+        # Rows appended by the bot have no Telegram ID column, but request IDs end with it
+        telegram_id = str(record.get('Request ID', '')).rpartition('_')[2]
+    return telegram_id
+
+def history_hours(record):
+    """(start date, [hours per day]) for a Leave History record, or None if its dates don't parse
+
+    Uses the per-day Hours column when it has one value per day, otherwise spreads
+    Total Hours evenly (rows entered by hand).
+    """
+    try:
+        start_date = date.fromisoformat(str(record.get('Start Date', '')).strip())
+        end_date = date.fromisoformat(str(record.get('End Date', '')).strip())
+    except ValueError:
+        return None
+    days = (end_date - start_date).days + 1
+    if days < 1:
+        return None
+    try:
+        hours = [float(h) for h in str(record.get('Hours', '')).split(',')]
+    except ValueError:
+        hours = []
+    if len(hours) != days:
+        try:
+            hours = [float(record.get('Total Hours') or 0) / days] * days
+        except ValueError:
+            hours = [0.0] * days
+    return start_date, hours
+
+class LeaveCalendar:
+    """Interval index of pending and approved leave, keyed by day and by requester
+
+    Every request is expanded into its days once, when it is added, so overlap checks
+    and per-day headcounts only touch the days asked about, never the whole history.
+    """
+    def __init__(self):
+        self.requests = {}   # request ID -> (telegram_id, {date ordinal: hours}, status)
+        self.days = {}       # date ordinal -> {request ID: (telegram_id, hours)}
+        self.user_days = {}  # telegram_id -> {date ordinal: {request ID, ...}}
+
+    def add(self, request_id, telegram_id, start_date, hours_per_day, status):
+        """Add or replace a request; hours_per_day lists the hours of each day from start_date"""
+        self.remove(request_id)
+        telegram_id = str(telegram_id)
+        first = start_date.toordinal()
+        # Days at 0 hours (weekends in a "weekdays" request) are not leave
+        hours = {first + i: value for i, value in enumerate(map(float, hours_per_day)) if value}
+        self.requests[request_id] = (telegram_id, hours, status)
+        user_days = self.user_days.setdefault(telegram_id, {})
+        for ordinal, value in hours.items():
+            self.days.setdefault(ordinal, {})[request_id] = (telegram_id, value)
+            user_days.setdefault(ordinal, set()).add(request_id)
+
+    def add_pending(self, request):
+        self.add(request.request_id, request.requester_id, request.start_date, request.hours_per_day, 'pending')
+
+    def remove(self, request_id):
+        entry = self.requests.pop(request_id, None)
+        if entry is None:
+            return
+        telegram_id, hours, _ = entry
+        user_days = self.user_days[telegram_id]
+        for ordinal in hours:
+            day = self.days[ordinal]
+            del day[request_id]
+            if not day:
+                del self.days[ordinal]
+            user_days[ordinal].discard(request_id)
+            if not user_days[ordinal]:
+                del user_days[ordinal]
+        if not user_days:
+            del self.user_days[telegram_id]
+
+    def discard_pending(self, request_id):
+        """Remove a request that was rejected or expired; approved leave stays"""
+        entry = self.requests.get(request_id)
+        if entry is not None and entry[2] == 'pending':
+            self.remove(request_id)
+
+    def replace_approved(self, records):
+        """Swap in approved leave from a fresh read of Leave History records"""
+        for request_id in [key for key, entry in self.requests.items() if entry[2] == 'approved']:
+            self.remove(request_id)
+        for row_number, record in enumerate(records):
+            self.add_approved(record, f"row:{row_number}")
+
+    def add_approved(self, record, fallback_key=None):
+        """Add a Leave History record; rows without a Request ID use fallback_key"""
+        parsed = history_hours(record)
+        request_id = record.get('Request ID') or fallback_key
+        if parsed is not None and request_id:
+            self.add(request_id, history_telegram_id(record), *parsed, 'approved')
+
+    def conflicts(self, telegram_id, start_date, end_date, exclude=None):
+        """Requests by telegram_id overlapping start_date..end_date (inclusive dates)
+
+        Returns [(request_id, first_day, last_day, status)] with days as "YYYY-MM-DD".
+        """
+        user_days = self.user_days.get(str(telegram_id), {})
+        found = set()
+        for ordinal in range(start_date.toordinal(), end_date.toordinal() + 1):
+            found.update(user_days.get(ordinal, ()))
+        found.discard(exclude)
+        result = []
+        for request_id in sorted(found):
+            _, hours, status = self.requests[request_id]
+            result.append((
+                request_id,
+                date.fromordinal(min(hours)).isoformat(),
+                date.fromordinal(max(hours)).isoformat(),
+                status
+            ))
+        return result
+
+    def day_load(self, start_date, end_date, exclude=None):
+        """[(day, people off, hours off)] for every day of start_date..end_date"""
+        result = []
+        for ordinal in range(start_date.toordinal(), end_date.toordinal() + 1):
+            people = set()
+            hours = 0.0
+            for request_id, (telegram_id, value) in self.days.get(ordinal, {}).items():
+                if request_id != exclude:
+                    people.add(telegram_id)
+                    hours += value
+            result.append((date.fromordinal(ordinal), len(people), hours))
+        return result
+
+class HolidayCalendar:
+    """Public holidays from a file of YYYY-MM-DD lines; anything after a comma or # is ignored
+
+    Kept in memory and re-read only when the file's mtime changes, so next year's
+    holidays can be added without a restart.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.error = None
+        self.holidays = frozenset()
+
+    def dates(self):
+        """The set of holiday dates, re-read first if the file changed"""
+        if not self.path:
+            return self.holidays
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime != self.mtime:
+                self.holidays = self.read()
+                self.mtime = mtime
+        except OSError as e:
+            # Keep the holidays read last; warn once per distinct problem
+            if str(e) != self.error:
+                logger.warning("Error reading holidays: %s", e)
+                self.error = str(e)
+            return self.holidays
+        self.error = None
+        return self.holidays
+
+    def read(self):
+        holidays = set()
+        with open(self.path, encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                text = line.split('#', 1)[0].split(',', 1)[0].strip()
+                if not text:
+                    continue
+                try:
+                    holidays.add(date.fromisoformat(text))
+                except ValueError:
+                    logger.warning("Ignoring line %d of %s: not a YYYY-MM-DD date", line_number, self.path)
+        logger.info("Loaded %d holidays from %s", len(holidays), self.path)
+        return frozenset(holidays)
+
+class LeaveHistoryIndex:
+    """Per-user monthly leave aggregates keyed by (telegram_id, "YYYY-MM")
+
+    Built from one read of the Leave History tab, updated in place when the bot appends
+    a row and rebuilt every HISTORY_REFRESH_INTERVAL seconds to catch manual edits.
+    Approved leave is also kept in calendar for overlap and headcount checks.
+    """
+    def __init__(self, gateway, ledger, calendar):
+        self.gateway = gateway
+        self.ledger = ledger
+        self.calendar = calendar
+        self.months = {}
+        self.request_ids = set()
+        # Approvals logged up to here are in the sheet or in the ledger's unsynced rows
+        self.ledger_seq = ledger.last_history_seq()
+        self.loaded = False
+        self.lock = asyncio.Lock()
+        self.added_during_refresh = None
+
+    async def refresh(self):
+        """Rebuild all aggregates from a single get_all_values() call"""
+        async with self.lock:
+            self.added_during_refresh = []
+            try:
+                history_sheet = await self.gateway.history_sheet()
+                values = await self.gateway.get_all_values(history_sheet)
+            except Exception:
+                self.added_during_refresh = None
+                raise
+            header = values[0] if values else []
+            months = {}
+            request_ids = set()
+            records = []
+            for row in values[1:]:
+                record = dict(zip(header, row))
+                request_ids.add(record.get('Request ID'))
+                self._add(months, record)
+                records.append(record)
+            # Keep rows appended while the sheet was being read, and approvals the ledger
+            # has not pushed yet, unless the read saw them
+            pending = self.added_during_refresh + [
+                history_record(telegram_id, values) for telegram_id, values in self.ledger.unsynced_history()
+            ]
+            for record in pending:
+                if record.get('Request ID') not in request_ids:
+                    request_ids.add(record.get('Request ID'))
+                    self._add(months, record)
+                    records.append(record)
+            self.added_during_refresh = None
+            self.months = months
+            self.request_ids = request_ids
+            self.calendar.replace_approved(records)
+            self.loaded = True
+
+    def _add(self, months, record):
+        key = (history_telegram_id(record), str(record.get('Timestamp', ''))[:7])
+        month = months.setdefault(key, {'hours': 0.0, 'entries': []})
+        try:
+            month['hours'] += float(record.get('Total Hours') or 0)
+        except ValueError:
+            pass
+        month['entries'].append({
+            'Start Date': record.get('Start Date'),
+            'End Date': record.get('End Date'),
+            'Total Hours': record.get('Total Hours'),
+            'Remarks': record.get('Remarks')
+        })
+
+    def add(self, record):
+        """Record a Leave History row the bot has just appended"""
+        if record.get('Request ID') in self.request_ids:
+            return
+        self.request_ids.add(record.get('Request ID'))
+        self._add(self.months, record)
+        self.calendar.add_approved(record)
+        if self.added_during_refresh is not None:
+            self.added_during_refresh.append(record)
+
+    def pull_ledger(self):
+        """Add approvals other instances logged in the shared ledger; returns the new records"""
+        added = []
+        for seq, telegram_id, values in self.ledger.history_since(self.ledger_seq):
+            self.ledger_seq = seq
+            record = history_record(telegram_id, values)
+            if record['Request ID'] not in self.request_ids:
+                self.add(record)
+                added.append(record)
+        return added
+
+    async def load(self):
+        """Read Leave History if it has not been read yet"""
+        if not self.loaded:
+            await self.refresh()
+
+    async def month_summary(self, telegram_id, month):
+        """Return {'hours': ..., 'entries': [...]} for a user and a "YYYY-MM" month"""
+        await self.load()
+        return self.months.get((str(telegram_id), month), {'hours': 0.0, 'entries': []})
+
+
+REPORT_FIELDS = ['Level', 'Team', 'Telegram ID', 'Name', 'People', 'Requests', 'Days', 'Hours']
+
+class LeaveReport:
+    """Per-user and per-team leave totals for a date range
+
+    Records are added one at a time as pages of Leave History are read, so memory
+    grows with the number of staff, not with the length of the history.
+    """
+    def __init__(self, start_date, end_date, teams):
+        self.start = start_date.strftime("%Y-%m-%d")
+        self.end = end_date.strftime("%Y-%m-%d")
+        self.first = start_date.toordinal()
+        self.last = end_date.toordinal()
+        self.teams = teams
+        self.users = {}  # telegram_id -> [name, requests, days, hours]
+
+    def add(self, record):
+        # ISO dates compare as strings, so most rows are skipped without parsing them
+        start = str(record.get('Start Date', '')).strip()
+        end = str(record.get('End Date', '')).strip()
+        if start > self.end or end < self.start:
+            return
+        parsed = history_hours(record)
+        if not parsed:
+            return
+        first = parsed[0].toordinal()
+        if first > self.last:
+            return
+        # Days at 0 hours (weekends in a "weekdays" request) are not leave
+        in_range = [hours for hours in parsed[1][max(self.first - first, 0):self.last - first + 1] if hours > 0]
+        if not in_range:
+            return
+        totals = self.users.setdefault(history_telegram_id(record), [record.get('Name', ''), 0, 0, 0.0])
+        totals[1] += 1
+        totals[2] += len(in_range)
+        totals[3] += sum(in_range)
+
+    def to_csv(self):
+        """CSV with a row per team (sorted by name) followed by a row per user"""
+        teams = {}
+        for telegram_id, (_, requests, days, hours) in self.users.items():
+            team = teams.setdefault(self.teams.get(telegram_id) or 'Unassigned', [0, 0, 0, 0.0])
+            team[0] += 1
+            team[1] += requests
+            team[2] += days
+            team[3] += hours
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(REPORT_FIELDS)
+        for team, (people, requests, days, hours) in sorted(teams.items()):
+            writer.writerow(['team', team, '', '', people, requests, days, f"{hours:g}"])
+        for telegram_id, (name, requests, days, hours) in sorted(
+            self.users.items(), key=lambda item: (self.teams.get(item[0]) or 'Unassigned', item[1][0])
+        ):
+            team = self.teams.get(telegram_id) or 'Unassigned'
+            writer.writerow(['user', team, telegram_id, name, 1, requests, days, f"{hours:g}"])
+        return output.getvalue()
+
+async def read_teams(gateway):
+    """Telegram ID -> team name from BALANCE_TEAM_COLUMN of sheet1, or {} if it is not set"""
+    if BALANCE_TEAM_COLUMN is None:
+        return {}
+    worksheet = await gateway.balance_sheet()
+    teams = {}
+    for row in await gateway.get_all_values(worksheet):
+        team = row[BALANCE_TEAM_COLUMN - 1].strip() if len(row) >= BALANCE_TEAM_COLUMN else ''
+        for telegram_id in balance_row_ids(row):
+            teams.setdefault(telegram_id, team)
+    return teams
+
+async def build_report(gateway, start_date, end_date, teams, unsynced=()):
+    """Stream Leave History through a LeaveReport, REPORT_PAGE_ROWS rows per request
+
+    unsynced are records committed locally but not yet in the sheet; they are added
+    unless the sheet turns out to have them already.
+    """
+    report = LeaveReport(start_date, end_date, teams)
+    unsynced = {record.get('Request ID'): record for record in unsynced}
+    worksheet = await gateway.history_sheet()
+    header = None
+    first_row = 1
+    while True:
+        page = await gateway.get_rows(worksheet, first_row, first_row + REPORT_PAGE_ROWS - 1)
+        rows = page
+        if header is None and page:
+            header, rows = page[0], page[1:]
+        for row in rows:
+            record = dict(zip(header, row))
+            unsynced.pop(record.get('Request ID'), None)
+            report.add(record)
+        first_row += REPORT_PAGE_ROWS
+        # Sheets leaves out trailing empty rows, so a short page may just end in blank
+        # rows; only an empty page past the sheet's known size ends the history
+        if not page and first_row > getattr(worksheet, 'row_count', 0):
+            break
+    for record in unsynced.values():
+        report.add(record)
+    return report
+
+def report_period(args, today=None):
+    """(start, end, month) for /report arguments: none (last month), YYYY-MM, or two dates
+
+    month is "YYYY-MM" when the period is one whole calendar month, else None.
+    """
+    if not args:
+        first_of_month = (today or datetime.now()).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        args = [(first_of_month - timedelta(days=1)).strftime("%Y-%m")]
+    if len(args) == 1:
+        start_date = datetime.strptime(args[0], "%Y-%m")
+        next_month = (start_date + timedelta(days=32)).replace(day=1)
+        return start_date, next_month - timedelta(days=1), args[0]
+    if len(args) == 2:
+        start_date = datetime.strptime(args[0], "%Y-%m-%d")
+        end_date = datetime.strptime(args[1], "%Y-%m-%d")
+        if start_date > end_date:
+            raise ValueError("Start date cannot be after end date")
+        return start_date, end_date, None
+    raise ValueError("Too many arguments")
+
+# CSV reports of closed months by "YYYY-MM"
+report_cache = OrderedDict()
+
+def invalidate_reports(start_date, end_date):
+    """Drop cached reports for every month a new history row covers ("YYYY-MM-DD" strings)"""
+    month = start_date[:7]
+    while month <= end_date[:7]:
+        report_cache.pop(month, None)
+        month = (datetime.strptime(month, "%Y-%m") + timedelta(days=32)).strftime("%Y-%m")
+
+
+class LedgerSync:
+    """Background task pushing ledger changes to Google Sheets in batches
+
+    Each push is one write_batch (one API request). A failed push is retried on the
+    next cycle; because a timed-out request may still have been applied, the first
+    push after a failure (or a restart, or taking over as leader) skips rows the Leave
+    History tab already has. Only the instance holding leader pushes.
+    """
+    def __init__(self, ledger, gateway, balance_index, interval, leader):
+        self.ledger = ledger
+        self.gateway = gateway
+        self.balance_index = balance_index
+        self.interval = interval
+        self.leader = leader
+        self.wakeup = None
+        self.task = None
+        self.stopping = False
+        self.verify_history = True
+
+    def start(self):
+        self.wakeup = asyncio.Event()
+        self.stopping = False
+        self.task = asyncio.create_task(self._run())
+
+    def notify(self):
+        """Push soon instead of waiting for the next interval"""
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    async def _run(self):
+        # stop() also cancels the task, but asyncio.wait_for can swallow a cancellation
+        # that arrives as the wakeup fires, so the flag is what ends the loop
+        while not self.stopping:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            if not self.leader.is_leader:
+                # The previous leader may have pushed rows without marking them synced
+                self.verify_history = True
+                continue
+            await self.push()
+
+    async def push(self):
+        """Push all pending ledger changes; returns False if Sheets could not be updated"""
+        # Hold the balance index lock so a sheet1 read cannot interleave with the write
+        async with self.balance_index.lock:
+            try:
+                balances, history = self.ledger.pending_changes(LEDGER_SYNC_BATCH)
+                if history and self.verify_history:
+                    history = await self._skip_already_appended(history)
+                if balances:
+                    balances = await self._current_rows(balances)
+                if balances or history:
+                    await self.gateway.write_batch(
+                        [(row, balance) for _, row, balance, _ in balances],
+                        [values for _, _, values in history]
+                    )
+                    self.ledger.mark_synced(balances, [seq for seq, _, _ in history])
+                self.verify_history = False
+                return True
+            except Exception as e:
+                logger.warning("Error syncing ledger to Google Sheets: %s", e)
+                self.verify_history = True
+                return False
+
+    async def _current_rows(self, balances):
+        """Balances with their rows looked up in a fresh read of sheet1
+
+        Rows may have been inserted or deleted by hand since a change was committed, and
+        writing to the row known then would overwrite someone else's balance. An ID no
+        longer in the sheet is left unsynced.
+        """
+        balance_sheet = await self.gateway.balance_sheet()
+        rows = {}
+        for row_number, row in enumerate(await self.gateway.get_all_values(balance_sheet), start=1):
+            for telegram_id in balance_row_ids(row):
+                rows.setdefault(telegram_id, row_number)
+        current = []
+        for telegram_id, row, balance, version in balances:
+            if telegram_id not in rows:
+                logger.warning("Telegram ID %s is no longer in the balance sheet; not pushing its balance", telegram_id)
+                continue
+            if rows[telegram_id] != row:
+                # The index has the old row too; have it re-read on the next lookup
+                self.balance_index.invalidate()
+            current.append((telegram_id, rows[telegram_id], balance, version))
+        return current
+
+    async def _skip_already_appended(self, history):
+        history_sheet = await self.gateway.history_sheet()
+        values = await self.gateway.get_all_values(history_sheet)
+        header = values[0] if values else []
+        if 'Request ID' not in header:
+            return history
+        column = header.index('Request ID')
+        appended = {row[column] for row in values[1:] if len(row) > column}
+        already = [seq for seq, request_id, _ in history if request_id in appended]
+        self.ledger.mark_synced([], already)
+        return [item for item in history if item[0] not in already]
+
+    async def stop(self, timeout=30):
+        """Stop the background task and make a last attempt to push pending changes"""
+        if self.task is not None:
+            self.stopping = True
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+            if not self.leader.is_leader:
+                return
+            # A push interrupted by the cancel may still have reached the sheet
+            self.verify_history = True
+            try:
+                await asyncio.wait_for(self.push(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Timed out pushing ledger changes at shutdown; they will be pushed on restart")
+
+
+# Request states
+PENDING_SUPERVISOR = "pending_supervisor"
+PENDING_DUTY_OPS = "pending_duty_ops"
+# Duty Ops approval is being committed; claimed so no other press or instance commits it too
+APPROVING = "approving"
 
 class LeaveRequest:
+    """A leave request; dates are parsed once and hours are kept per day from start_date"""
+    # Persisted by to_record(), in this order
+    FIELDS = (
+        'requester_id', 'requester_name', 'requester_handle', 'start_date', 'end_date',
+        'hours_per_day', 'remarks', 'request_id', 'timestamp', 'supervisor_approval',
+        'supervisor_id', 'status'
+    )
+    __slots__ = FIELDS + ('total_hours', 'rendered_details')
+
     def __init__(self, requester_id, requester_name, requester_handle, 
-                 start_date, end_date, hours_per_day, remarks, request_id):
+                 start_date, end_date, hours_per_day, remarks, request_id, timestamp=None):
         self.requester_id = requester_id
         self.requester_name = requester_name
         self.requester_handle = requester_handle
         self.start_date = start_date
         self.end_date = end_date
-        self.hours_per_day = hours_per_day
+        self.hours_per_day = tuple(hours_per_day)
         self.remarks = remarks
         self.request_id = request_id
-        self.timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.timestamp = timestamp or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         self.supervisor_approval = None
         self.supervisor_id = None
+        self.status = PENDING_SUPERVISOR
+        self.total_hours = sum(self.hours_per_day)
+        self.rendered_details = None
+
+    def details(self):
+        """Dates, per-day hours and total, rendered on first use and reused by every message"""
+        if self.rendered_details is None:
+            self.rendered_details = DETAILS_TEMPLATE.format(
+                start_date=self.start_date,
+                end_date=self.end_date,
+                hours="\n".join(format_runs(self.start_date, self.hours_per_day, "{:g} hours")),
+                total_hours=f"{self.total_hours:g}"
+            )
+        return self.rendered_details
+
+    def to_record(self):
+        """Serialize to a compact JSON array, in FIELDS order"""
+        values = [getattr(self, name) for name in self.FIELDS]
+        values[3] = self.start_date.isoformat()
+        values[4] = self.end_date.isoformat()
+        values[5] = list(self.hours_per_day)
+        return json.dumps(values, separators=(',', ':'))
+
+    @classmethod
+    def from_record(cls, record):
+        values = dict(zip(cls.FIELDS, json.loads(record)))
+        hours_per_day = values['hours_per_day']
+        if isinstance(hours_per_day, dict):
+            # Records saved before hours were kept as a list: {"YYYY-MM-DD": hours}
+            hours_per_day = [hours for _, hours in sorted(hours_per_day.items())]
+        request = cls.__new__(cls)
+        for name in cls.FIELDS:
+            setattr(request, name, values.get(name))
+        request.start_date = date.fromisoformat(values['start_date'])
+        request.end_date = date.fromisoformat(values['end_date'])
+        request.hours_per_day = tuple(hours_per_day)
+        request.total_hours = sum(request.hours_per_day)
+        request.rendered_details = None
+        return request
+
+class PendingRequestStore:
+    """SQLite-backed store of in-flight leave requests, so approvals survive restarts"""
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS pending_requests ("
+            "request_id TEXT PRIMARY KEY, created_at REAL NOT NULL, record TEXT NOT NULL)"
+        )
+        # Log of saves and deletes, so other instances can read only what changed
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS pending_changes ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, request_id TEXT NOT NULL, changed_at REAL NOT NULL)"
+        )
+        self.conn.commit()
+
+    def _log_changes(self, request_ids):
+        now = time.time()
+        self.conn.executemany(
+            "INSERT INTO pending_changes (request_id, changed_at) VALUES (?, ?)",
+            [(request_id, now) for request_id in request_ids]
+        )
+
+    # Where to_record() puts the status, for compare-and-set updates
+    STATUS_PATH = f"$[{LeaveRequest.FIELDS.index('status')}]"
+
+    def save(self, request, expected_status=None):
+        """Insert or update a request; call on creation and on every state change
+
+        With expected_status, only an existing request still in that state is updated,
+        so of two presses (on this instance or another) only one moves it on. Returns
+        whether the request was written.
+        """
+        with self.conn:
+            if expected_status is not None:
+                cursor = self.conn.execute(
+                    "UPDATE pending_requests SET record = ? WHERE request_id = ? AND json_extract(record, ?) = ?",
+                    (request.to_record(), request.request_id, self.STATUS_PATH, expected_status)
+                )
+                if cursor.rowcount != 1:
+                    return False
+            else:
+                self.conn.execute(
+                    "INSERT INTO pending_requests (request_id, created_at, record) VALUES (?, ?, ?) "
+                    "ON CONFLICT(request_id) DO UPDATE SET record = excluded.record",
+                    (request.request_id, time.time(), request.to_record())
+                )
+            self._log_changes([request.request_id])
+            return True
+
+    def delete(self, request_id, expected_status=None):
+        """Delete a request, with expected_status only if it is still in that state; returns whether it was"""
+        with self.conn:
+            if expected_status is not None:
+                cursor = self.conn.execute(
+                    "DELETE FROM pending_requests WHERE request_id = ? AND json_extract(record, ?) = ?",
+                    (request_id, self.STATUS_PATH, expected_status)
+                )
+            else:
+                cursor = self.conn.execute("DELETE FROM pending_requests WHERE request_id = ?", (request_id,))
+            if cursor.rowcount != 1:
+                return False
+            self._log_changes([request_id])
+            return True
+
+    def get(self, request_id):
+        """Return the stored request, or None"""
+        found = self.conn.execute(
+            "SELECT record FROM pending_requests WHERE request_id = ?", (request_id,)
+        ).fetchone()
+        return LeaveRequest.from_record(found[0]) if found else None
+
+    def load(self):
+        """Return all stored requests as {request_id: LeaveRequest}"""
+        rows = self.conn.execute("SELECT request_id, record FROM pending_requests")
+        return {request_id: LeaveRequest.from_record(record) for request_id, record in rows}
+
+    def evict_older_than(self, max_age):
+        """Delete requests created more than max_age seconds ago and return their IDs
+
+        A request being approved is left alone: its hours may already be deducted.
+        """
+        cutoff = time.time() - max_age
+        where = "created_at < ? AND json_extract(record, ?) != ?"
+        with self.conn:
+            expired = [
+                request_id for (request_id,) in self.conn.execute(
+                    f"SELECT request_id FROM pending_requests WHERE {where}", (cutoff, self.STATUS_PATH, APPROVING)
+                )
+            ]
+            self.conn.execute(f"DELETE FROM pending_requests WHERE {where}", (cutoff, self.STATUS_PATH, APPROVING))
+            self._log_changes(expired)
+        return expired
+
+    def last_change(self):
+        """Sequence number of the latest save or delete, by any process"""
+        found = self.conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'pending_changes'").fetchone()
+        return found[0] if found else 0
+
+    def changes_since(self, seq):
+        """(latest seq, {request_id: LeaveRequest, or None if deleted}) for changes after seq
+
+        Reads only the requests saved or deleted since seq, by any process. The changes
+        are None if the log has been trimmed past seq; load() everything instead.
+        """
+        with self.conn:
+            # One read transaction, so the log and the records are seen at the same point
+            self.conn.execute("BEGIN")
+            last = self.last_change()
+            if last == seq:
+                return seq, {}
+            (first,) = self.conn.execute("SELECT MIN(seq) FROM pending_changes").fetchone()
+            if (last + 1 if first is None else first) > seq + 1:
+                return last, None
+            rows = self.conn.execute(
+                "SELECT changed.request_id, pending_requests.record FROM "
+                "(SELECT DISTINCT request_id FROM pending_changes WHERE seq > ? AND seq <= ?) AS changed "
+                "LEFT JOIN pending_requests USING (request_id)",
+                (seq, last)
+            )
+            return last, {
+                request_id: None if record is None else LeaveRequest.from_record(record)
+                for request_id, record in rows
+            }
+
+    def trim_changes(self, max_age):
+        """Forget changes logged more than max_age seconds ago"""
+        with self.conn:
+            self.conn.execute("DELETE FROM pending_changes WHERE changed_at < ?", (time.time() - max_age,))
+
+    def close(self):
+        self.conn.close()
+
+class LocalState:
+    """Conversations, /pending lists and outcomes kept in this process, which always leads
+
+    The default for a single instance. A shared backend implements the same methods
+    (SqliteSharedState below; Redis or similar would do too) and sets shared = True.
+    """
+    shared = False
+
+    def __init__(self):
+        self.namespaces = {}
+
+    def get(self, namespace, key):
+        return self.namespaces.get(namespace, {}).get(key)
+
+    def put(self, namespace, key, value, keep=None):
+        """Store value under key; with keep, forget the oldest keys beyond that many"""
+        entries = self.namespaces.setdefault(namespace, OrderedDict())
+        entries.pop(key, None)
+        entries[key] = value
+        while keep is not None and len(entries) > keep:
+            entries.popitem(last=False)
+
+    def delete(self, namespace, key):
+        self.namespaces.get(namespace, {}).pop(key, None)
+
+    def acquire_lease(self, name, holder, ttl):
+        """Take or renew a lease for ttl seconds; returns whether holder has it"""
+        return True
+
+    def release_lease(self, name, holder):
+        pass
+
+    def close(self):
+        pass
+
+class SqliteSharedState:
+    """State shared by bot instances through one SQLite file
+
+    Works for processes on one host, or on a volume with working file locks. Values are
+    pickled, like PicklePersistence, so the file must only be writable by the bot. Lease
+    expiry uses wall-clock time, so hosts sharing the file need synchronised clocks.
+    """
+    shared = True
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, timeout=10)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, PRIMARY KEY (namespace, key))"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS leases ("
+            "name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self.conn.commit()
+
+    def get(self, namespace, key):
+        found = self.conn.execute(
+            "SELECT value FROM state WHERE namespace = ? AND key = ?", (namespace, key)
+        ).fetchone()
+        return pickle.loads(found[0]) if found else None
+
+    def put(self, namespace, key, value, keep=None):
+        """Store value under key; with keep, forget the oldest keys beyond that many"""
+        with self.conn:
+            # REPLACE gives the row a new rowid, so rowid order is least recently stored first
+            self.conn.execute(
+                "INSERT OR REPLACE INTO state (namespace, key, value) VALUES (?, ?, ?)",
+                (namespace, key, pickle.dumps(value))
+            )
+            if keep is not None:
+                self.conn.execute(
+                    "DELETE FROM state WHERE namespace = ? AND rowid NOT IN "
+                    "(SELECT rowid FROM state WHERE namespace = ? ORDER BY rowid DESC LIMIT ?)",
+                    (namespace, namespace, keep)
+                )
+
+    def delete(self, namespace, key):
+        with self.conn:
+            self.conn.execute("DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def acquire_lease(self, name, holder, ttl):
+        """Take or renew a lease for ttl seconds; returns whether holder has it"""
+        now = time.time()
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at "
+                "WHERE leases.holder = excluded.holder OR leases.expires_at < ?",
+                (name, holder, now + ttl, now)
+            )
+            (current,) = self.conn.execute("SELECT holder FROM leases WHERE name = ?", (name,)).fetchone()
+        return current == holder
+
+    def release_lease(self, name, holder):
+        with self.conn:
+            self.conn.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+
+    def close(self):
+        self.conn.close()
+
+class LeaderLease:
+    """Decides which instance runs the singleton jobs: ledger pushes, accrual, eviction
+
+    The lease is renewed every third of its TTL. An instance that stops renewing (it
+    crashed, or lost the shared state) is replaced once the lease runs out, and one
+    that fails to renew steps down straight away.
+    """
+    def __init__(self, state, holder, ttl):
+        self.state = state
+        self.holder = holder
+        self.ttl = ttl
+        self.is_leader = False
+
+    def renew(self):
+        try:
+            leader = self.state.acquire_lease('leader', self.holder, self.ttl)
+        except Exception as e:
+            logger.warning("Error renewing the leader lease: %s", e)
+            leader = False
+        if leader != self.is_leader:
+            logger.info("%s %s the leader", self.holder, "is now" if leader else "is no longer")
+        self.is_leader = leader
+        return leader
+
+    def release(self):
+        """Hand the lease over at shutdown instead of letting it run out"""
+        if self.is_leader:
+            self.is_leader = False
+            try:
+                self.state.release_lease('leader', self.holder)
+            except Exception as e:
+                logger.warning("Error releasing the leader lease: %s", e)
+
+
+user_locks = {}
+
+def user_lock(telegram_id):
+    """Lock serializing balance changes for one user"""
+    return user_locks.setdefault(str(telegram_id), asyncio.Lock())
+
+def history_row(request, duty_ops_name):
+    """Leave History row for a fully approved request"""
+    return [
+        request.timestamp,
+        request.requester_name,
+        request.requester_handle,
+        request.start_date.isoformat(),
+        request.end_date.isoformat(),
+        # Format hours for history
+        ",".join(str(h) for h in request.hours_per_day),
+        request.total_hours,
+        request.remarks,
+        request.request_id,
+        request.supervisor_approval,
+        duty_ops_name
+    ]
+
+async def commit_approval(request, duty_ops_name):
+    """Deduct an approved request from the balance and log it in Leave History
+
+    Runs under the requester's lock and commits both changes in one ledger transaction,
+    so two approvals for the same person can no longer lose a deduction. The sheet is
+    updated in the background by LedgerSync. Returns the new balance.
+    """
+    [result] = await commit_approvals([request], duty_ops_name)
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+async def commit_approvals(requests, duty_ops_name):
+    """Approve several requests as one batch; returns a new balance or an exception for each
+
+    Rows come from the in-memory index (one sheet read at most), all deductions and
+    history rows go into one ledger transaction, and LedgerSync pushes them in a single
+    batch_update. A requester missing from the sheet only fails their own requests.
+    """
+    results = [None] * len(requests)
+    approvals = []
+    committed = []
+    async with contextlib.AsyncExitStack() as stack:
+        # Sorted, so two batches sharing requesters cannot deadlock
+        for telegram_id in sorted({str(request.requester_id) for request in requests}):
+            await stack.enter_async_context(user_lock(telegram_id))
+        entries = {}
+        for i, request in enumerate(requests):
+            telegram_id = str(request.requester_id)
+            if telegram_id not in entries:
+                try:
+                    entries[telegram_id] = await balance_index.lookup(telegram_id)
+                except ValueError as e:
+                    # A blank or non-numeric balance cell fails only this requester
+                    entries[telegram_id] = e
+            entry = entries[telegram_id]
+            if isinstance(entry, Exception):
+                results[i] = entry
+                continue
+            if not entry:
+                results[i] = Exception("User not found in leave balance sheet")
+                continue
+            row, _ = entry
+            values = history_row(request, duty_ops_name)
+            approvals.append((request.requester_id, row, request.total_hours, request.request_id, values))
+            committed.append(i)
+        if approvals:
+            try:
+                new_balances = ledger.record_approvals(approvals)
+            except Exception as e:
+                for i in committed:
+                    results[i] = e
+                return results
+            for i, (telegram_id, _, _, _, values), new_balance in zip(committed, approvals, new_balances):
+                if isinstance(new_balance, Exception):
+                    results[i] = new_balance
+                    continue
+                balance_index.set_balance(telegram_id, new_balance)
+                history_index.add(history_record(telegram_id, values))
+                invalidate_reports(values[3], values[4])
+                results[i] = new_balance
+    ledger_sync.notify()
+    return results
+
+async def adjust_balances(batch, credits):
+    """Add hours to balances, at most once per batch and person; returns (applied, unknown IDs)
+
+    credits maps Telegram ID -> hours, or is a number of hours for every row of sheet1.
+    sheet1 is read once, then under the same per-user locks approvals take, all credits
+    are committed in one ledger transaction, which LedgerSync pushes as a single
+    batch_update. Re-running a batch only credits people it has not reached yet (e.g.
+    rows added to the sheet since).
+    """
+    applied = ledger.applied_adjustments(batch)
+
+    def outstanding():
+        if isinstance(credits, dict):
+            return {str(telegram_id): hours for telegram_id, hours in credits.items()
+                    if str(telegram_id) not in applied}
+        # Once per row: with BALANCE_ID_COLUMN unset a row may match several IDs
+        first_ids = {}
+        for telegram_id, (row, _) in balance_index.entries.items():
+            first_ids.setdefault(row, telegram_id)
+        return {telegram_id: credits for telegram_id in first_ids.values() if telegram_id not in applied}
+
+    # Cheap check against the cached index first, so finished batches cost no Sheets read
+    if balance_index.loaded_at is not None and not outstanding():
+        return 0, []
+    await balance_index.refresh()
+    todo = outstanding()
+    if not todo:
+        return 0, []
+    unknown = sorted(telegram_id for telegram_id in todo if telegram_id not in balance_index.entries)
+    known = [telegram_id for telegram_id in todo if telegram_id in balance_index.entries]
+    known_rows = {balance_index.entries[telegram_id][0] for telegram_id in known}
+    # Every ID sharing a row with someone being credited, so approvals through any of them wait
+    lock_ids = sorted(telegram_id for telegram_id, (row, _) in balance_index.entries.items() if row in known_rows)
+
+    changes = []
+    async with contextlib.AsyncExitStack() as stack:
+        for telegram_id in lock_ids:
+            await stack.enter_async_context(user_lock(telegram_id))
+        for telegram_id in known:
+            row, balance = balance_index.entries[telegram_id]
+            try:
+                float(balance)
+            except ValueError:
+                logger.warning("Skipping %s for %s: balance %r is not a number", batch, telegram_id, balance)
+                continue
+            changes.append((telegram_id, row, float(todo[telegram_id])))
+        new_balances = ledger.record_adjustments(batch, changes)
+        for (telegram_id, _, _), new_balance in zip(changes, new_balances):
+            balance_index.set_balance(telegram_id, new_balance)
+    ledger_sync.notify()
+    return len(changes), unknown
+
+def read_adjustments(path):
+    """{telegram_id: hours} from a CSV with telegram_id and hours columns (others are ignored)"""
+    with open(path, newline='') as f:
+        credits = {}
+        for line, record in enumerate(csv.DictReader(f), start=2):
+            try:
+                telegram_id = record['telegram_id'].strip()
+                credits[telegram_id] = credits.get(telegram_id, 0.0) + float(record['hours'])
+            except (KeyError, AttributeError, ValueError):
+                raise ValueError(f"line {line}: needs a telegram_id and a numeric hours value")
+    return credits
+
+class NotificationQueue:
+    """Background sender for outgoing messages
+
+    Each chat gets its own worker task so messages to one chat keep their order while
+    different chats are served concurrently. Sends respect Telegram's global and
+    per-chat rate limits and are retried with backoff, honouring retry_after on 429s.
+    """
+    def __init__(self, max_retries):
+        self.max_retries = max_retries
+        self.bot = None
+        self.chats = {}
+        self.workers = set()
+        self.next_global_slot = 0.0
+
+    def start(self, bot):
+        self.bot = bot
+
+    def enqueue(self, chat_id, text, **kwargs):
+        """Queue a message for chat_id and return immediately"""
+        key = str(chat_id)
+        queue = self.chats.get(key)
+        if queue is None:
+            queue = self.chats[key] = asyncio.Queue()
+            worker = asyncio.create_task(self._drain(key, queue))
+            self.workers.add(worker)
+            worker.add_done_callback(self.workers.discard)
+        queue.put_nowait((current_request_id.get(), chat_id, text, kwargs))
+
+    def depth(self):
+        """Messages waiting to be sent"""
+        return sum(queue.qsize() for queue in self.chats.values())
+
+    async def _drain(self, key, queue):
+        interval = GROUP_CHAT_INTERVAL if key.startswith(('-', '@')) else PRIVATE_CHAT_INTERVAL
+        try:
+            while not queue.empty():
+                request_id, chat_id, text, kwargs = queue.get_nowait()
+                current_request_id.set(request_id)
+                await self._send(chat_id, text, kwargs)
+                if not queue.empty():
+                    await asyncio.sleep(interval)
+        finally:
+            # No await between the empty() check and here, so no message can be stranded
+            del self.chats[key]
+
+    async def _wait_global_slot(self):
+        now = time.monotonic()
+        slot = max(now, self.next_global_slot)
+        self.next_global_slot = slot + 1 / TELEGRAM_GLOBAL_RATE
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _send(self, chat_id, text, kwargs):
+        for attempt in range(self.max_retries + 1):
+            await self._wait_global_slot()
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                metrics.inc('leave_bot_messages_sent_total')
+                return
+            except RetryAfter as e:
+                delay = e.retry_after
+                delay = delay.total_seconds() if isinstance(delay, timedelta) else delay
+                metrics.inc('leave_bot_send_failures_total', [('reason', 'retry_after')])
+                logger.info("Rate limited sending to %s, retrying in %ss", chat_id, delay)
+            except (BadRequest, Forbidden) as e:
+                # Chat not found, bot blocked, message too long... retrying will not help.
+                # Caught first: BadRequest is a NetworkError in python-telegram-bot
+                metrics.inc('leave_bot_send_failures_total', [('reason', 'rejected')])
+                logger.error("Error sending message to %s: %s", chat_id, e)
+                return
+            except NetworkError as e:
+                delay = min(2 ** attempt, 60)
+                metrics.inc('leave_bot_send_failures_total', [('reason', 'network')])
+                logger.warning("Error sending message to %s (attempt %d): %s", chat_id, attempt + 1, e)
+            except TelegramError as e:
+                metrics.inc('leave_bot_send_failures_total', [('reason', 'rejected')])
+                logger.error("Error sending message to %s: %s", chat_id, e)
+                return
+            if attempt < self.max_retries:
+                await asyncio.sleep(delay)
+        metrics.inc('leave_bot_send_failures_total', [('reason', 'gave_up')])
+        logger.error("Giving up sending message to %s after %d attempts", chat_id, self.max_retries + 1)
+
+    async def stop(self, timeout=30):
+        """Wait for queued messages to be sent, then cancel whatever is left"""
+        if self.workers:
+            done, not_done = await asyncio.wait(set(self.workers), timeout=timeout)
+            for worker in not_done:
+                worker.cancel()
+
+
+class StatusServer:
+    """Minimal HTTP server for health checks on a local port
+
+    Routes map a path to a function returning (status, content_type, body).
+    """
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.routes = {}
+        self.server = None
+
+    def add_route(self, path, handler):
+        self.routes[path] = handler
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            # Skip the headers, nothing here needs them
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            path = parts[1].split('?')[0] if len(parts) >= 2 else ''
+            handler = self.routes.get(path)
+            if handler is None:
+                status, content_type, body = 404, 'text/plain', 'not found\n'
+            else:
+                status, content_type, body = handler()
+            body = body.encode()
+            reason = {200: 'OK', 404: 'Not Found', 503: 'Service Unavailable'}.get(status, '')
+            writer.write(
+                f"HTTP/1.1 {status} {reason}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+
+def update_key(update):
+    """Serialization key: the request a button press is for, else the conversation"""
+    if isinstance(update, Update):
+        query = update.callback_query
+        if query and query.data and query.data.startswith('pending_') and query.message:
+            # Buttons of one /pending list share its selection
+            return f"pending:{query.message.chat_id}:{query.message.message_id}"
+        if query and query.data and not query.data.startswith('calendar_'):
+            parts = query.data.split('_', 2)
+            if len(parts) == 3:
+                return f"request:{parts[2]}"
+        # One /request conversation, calendar presses included: a user in a chat
+        chat_id = update.effective_chat.id if update.effective_chat else None
+        user_id = update.effective_user.id if update.effective_user else None
+        return f"conversation:{chat_id}:{user_id}"
+    return None
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently, but one at a time per request and per conversation
+
+    A slow /balance no longer holds up everyone else, while two presses on the same
+    request (a double click, or supervisor and Duty Ops at once) still run in order.
+    """
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self.locks = {}
+        self.in_flight = 0
+        self.first_update_seconds = None
+
+    async def do_process_update(self, update, coroutine):
+        self.in_flight += 1
+        try:
+            await self._process_in_order(update, coroutine)
+        finally:
+            self.in_flight -= 1
+            if self.first_update_seconds is None:
+                self.first_update_seconds = time.monotonic() - started_at
+                logger.info("First update processed %.2fs after start", self.first_update_seconds)
+                metrics.gauge(
+                    'leave_bot_first_update_seconds',
+                    lambda: self.first_update_seconds,
+                    'Seconds from process start to the first processed update'
+                )
+
+    async def _process_in_order(self, update, coroutine):
+        key = update_key(update)
+        if key is None:
+            await coroutine
+            return
+        entry = self.locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+def finish_request(context, request_id, outcome):
+    """Drop a request that needs no further action and remember how it ended
+
+    Outcomes are kept in shared_state, so repeated button presses are answered cheaply
+    whichever instance they reach.
+    """
+    logger.info("Leave request %s", outcome)
+    context.bot_data.setdefault('pending_requests', {}).pop(request_id, None)
+    pending_store.delete(request_id)
+    leave_calendar.discard_pending(request_id)
+    shared_state.put('outcomes', request_id, outcome, keep=PROCESSED_REQUESTS_KEPT)
+
+def find_request(context, request_id):
+    """The pending request, read from the store when other instances may have changed it"""
+    pending = context.bot_data.setdefault('pending_requests', {})
+    if not shared_state.shared:
+        return pending.get(request_id)
+    request = pending_store.get(request_id)
+    if request is None:
+        pending.pop(request_id, None)
+    else:
+        keep_rendered(pending, request)
+    return request
+
+def keep_rendered(pending, request):
+    """Put a request read back from the store in pending, reusing its rendered details
+
+    Dates and hours never change after creation, so the details block rendered for
+    the copy already in memory is still right.
+    """
+    known = pending.get(request.request_id)
+    if known is not None and request.rendered_details is None:
+        request.rendered_details = known.rendered_details
+    pending[request.request_id] = request
+
+def transition(context, request, status, **changes):
+    """Move a request on to status, unless another press or instance already moved it
+
+    Returns the updated request, or None if the stored request is no longer in
+    request.status. The request passed in is left as it was.
+    """
+    # A shallow copy keeps the rendered details; every field it shares is immutable
+    updated = copy.copy(request)
+    for name, value in changes.items():
+        setattr(updated, name, value)
+    updated.status = status
+    if not pending_store.save(updated, expected_status=request.status):
+        return None
+    context.bot_data.setdefault('pending_requests', {})[request.request_id] = updated
+    return updated
+
+def sync_shared_state(application):
+    """Pick up requests and approvals other instances have stored since the last call
+
+    Only requests saved or deleted since the last call are read. Does nothing with
+    LocalState, where this process already has everything.
+    """
+    if not shared_state.shared:
+        return
+    pending = application.bot_data.setdefault('pending_requests', {})
+    seq, changed = pending_store.changes_since(application.bot_data.get('pending_seq', 0))
+    if changed is None:
+        # Not synced for longer than the change log is kept
+        changed = dict.fromkeys(pending)
+        changed.update(pending_store.load())
+    for request_id, request in changed.items():
+        if request is None:
+            pending.pop(request_id, None)
+            leave_calendar.discard_pending(request_id)
+        else:
+            keep_rendered(pending, request)
+            leave_calendar.add_pending(request)
+    application.bot_data['pending_seq'] = seq
+    sync_history()
+
+def sync_history():
+    """Pick up approvals other instances have logged in the ledger since the last call"""
+    if not shared_state.shared:
+        return
+    for record in history_index.pull_ledger():
+        invalidate_reports(record['Start Date'], record['End Date'])
+
+async def load_user_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Before the handlers: replace this user's user_data with the shared copy
+
+    user_data holds the /request conversation, so the next step can reach any instance.
+    """
+    if update.effective_user is None:
+        return
+    stored = shared_state.get('user_data', str(update.effective_user.id)) or {}
+    context.user_data.clear()
+    context.user_data.update(stored)
+    loaded_user_data.set(stored)
+
+async def save_user_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """After the handlers: store this user's user_data if they changed it"""
+    if update.effective_user is None or context.user_data == loaded_user_data.get():
+        return
+    if context.user_data:
+        shared_state.put('user_data', str(update.effective_user.id), dict(context.user_data))
+    else:
+        shared_state.delete('user_data', str(update.effective_user.id))
 
 # function to check leave balance
+@timed
 async def check_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Check user's leave balance"""
     user = update.effective_user
-    
-    try:
-        # Open the spreadsheet
-        worksheet = client.open_by_key(SPREADSHEET_ID).sheet1
-        
-        # Find user's row by Telegram ID
-        cell = worksheet.find(str(user.id))
-        if cell:
-            row = cell.row
-            
-            # Get user's leave balance
-            balance = float(worksheet.cell(row, 4).value)
-            
-            # Get leave history for current month
-            history_sheet = client.open_by_key(SPREADSHEET_ID).worksheet("Leave History")
-            all_records = history_sheet.get_all_records()
+    
+    try:
+        # Find user's row and leave balance by Telegram ID
+        entry = await balance_index.lookup(user.id)
+        if entry:
+            row, balance = entry
             
-            # Filter records for current user and current month
+            # Get leave history and total hours taken for current month
+            sync_history()
             current_month = datetime.now().strftime("%Y-%m")
-            month_records = [
-                record for record in all_records 
-                if record.get('Telegram ID', '') == str(user.id) and 
-                record.get('Timestamp', '').startswith(current_month)
-            ]
-            
-            # Calculate total hours taken this month
-            month_hours = sum(float(record.get('Total Hours', 0)) for record in month_records)
+            summary = await history_index.month_summary(user.id, current_month)
+            month_records = summary['entries']
+            month_hours = summary['hours']
             
             # Prepare the response message
             message = (
@@ -106,29 +2310,109 @@ async def check_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             
     except Exception as e:
-        print(f"Error checking balance: {e}")
+        logger.exception("Error checking balance")
         await update.message.reply_text(
             "❌ Error checking leave balance. Please try again later or contact administrator."
         )
 
 
 
-def format_hours_display(leave_request):
-    """Helper function to format hours display"""
-    hours_display = []
-    start_date = datetime.strptime(leave_request.start_date, "%Y-%m-%d")
-    end_date = datetime.strptime(leave_request.end_date, "%Y-%m-%d")
-    
-    current_date = start_date
-    while current_date <= end_date:
-        date_str = current_date.strftime("%Y-%m-%d")
-        hours = leave_request.hours_per_day[date_str]
-        date_display = current_date.strftime("%b %d")
-        hours_display.append(f"- {date_display}: {hours} hours")
-        current_date += timedelta(days=1)
-    
-    return hours_display
+# Message templates, filled with str.format; {details} is LeaveRequest.details()
+DETAILS_TEMPLATE = (
+    "Dates: {start_date} to {end_date}\n"
+    "Hours:\n"
+    "{hours}\n"
+    "Total Hours: {total_hours}"
+)
+SUBMITTED_TEMPLATE = (
+    "Your leave request has been submitted:\n"
+    "{details}\n"
+    "Remarks: {remarks}\n"
+    "Request ID: {request_id}\n\n"
+    "Supervisors have been notified."
+)
+SUPERVISOR_TEMPLATE = (
+    "🔔 New Leave Request\n\n"
+    "From: {requester_name} (@{requester_handle})\n"
+    "{details}\n"
+    "Remarks: {remarks}\n"
+    "Time: {timestamp}"
+)
+DUTY_OPS_TEMPLATE = (
+    "🔔 Leave Request for Final Approval\n\n"
+    "From: {requester_name} (@{requester_handle})\n"
+    "{details}\n"
+    "Remarks: {remarks}\n"
+    "Approved by: {supervisor_approval}\n"
+    "Time: {timestamp}\n\n"
+    "Already off (approved and pending):\n"
+    "{day_load}"
+)
+APPROVED_TEMPLATE = (
+    "✅ Your leave request has been fully approved!\n"
+    "{details}\n"
+    "Approved by:\n"
+    "Supervisor: {supervisor_approval}\n"
+    "Duty Ops: {duty_ops_name}\n"
+    "Updated leave balance: {new_balance} hours"
+)
+
+def render(template, leave_request, **fields):
+    """Fill a message template from a request, reusing its rendered details block"""
+    return template.format(
+        details=leave_request.details(),
+        requester_name=leave_request.requester_name,
+        requester_handle=leave_request.requester_handle,
+        remarks=leave_request.remarks,
+        request_id=leave_request.request_id,
+        timestamp=leave_request.timestamp,
+        supervisor_approval=leave_request.supervisor_approval,
+        **fields
+    )
+
+def format_runs(start_date, values, value_format):
+    """One line per run of identical consecutive days, e.g. "- Mar 01–Mar 14: 8 hours ×14"
+
+    Keeps messages for long ranges short; past MAX_BREAKDOWN_LINES the rest is summarised.
+    """
+    runs = []
+    for value in values:
+        if runs and runs[-1][0] == value:
+            runs[-1][1] += 1
+        else:
+            runs.append([value, 1])
+    lines = []
+    day = start_date
+    for i, (value, count) in enumerate(runs):
+        if i == MAX_BREAKDOWN_LINES:
+            remaining = sum(count for _, count in runs[i:])
+            lines.append(f"- … {remaining} more days to {start_date + timedelta(days=len(values) - 1):%b %d}")
+            break
+        last = day + timedelta(days=count - 1)
+        if count == 1:
+            lines.append(f"- {day:%b %d}: {value_format.format(value)}")
+        else:
+            lines.append(f"- {day:%b %d}–{last:%b %d}: {value_format.format(value)} ×{count}")
+        day = last + timedelta(days=1)
+    return lines
+
+def format_conflicts(conflicts):
+    """Message listing a user's requests that overlap the dates they asked for"""
+    lines = ["You already have leave on some of these dates:"]
+    for request_id, first_day, last_day, status in conflicts:
+        lines.append(f"- {first_day} to {last_day} ({status}, {request_id})")
+    return "\n".join(lines)
+
+def format_day_load(leave_request):
+    """Per-day headcount and hours already off, excluding the request itself"""
+    load = leave_calendar.day_load(leave_request.start_date, leave_request.end_date, exclude=leave_request.request_id)
+    return format_runs(
+        leave_request.start_date,
+        [(people, hours) for _, people, hours in load],
+        "{0[0]} off, {0[1]:g} hours"
+    )
 
+@timed
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start command handler"""
     user = update.effective_user
@@ -139,144 +2423,303 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"Your Username: @{user.username if user.username else 'not set'}\n\n"
         "Available commands:\n"
         "/request - Start a new leave request\n"
+        "/request YYYY-MM-DD..YYYY-MM-DD 8 weekdays \"remarks\" - Request leave in one message\n"
         "/balance - Check your leave balance\n"
         "/cancel - Cancel current leave request"
     )
 
+DATES_PROMPT = (
+    "Please enter the date(s) for your leave, or pick them below:\n"
+    "Format: YYYY-MM-DD or YYYY-MM-DD to YYYY-MM-DD\n"
+    "Example: 2025-02-15 or 2025-02-15 to 2025-02-17"
+)
+HOURS_PROMPT = (
+    "Please enter the hours for each day ({days} days):\n"
+    "- Same hours each day: 8\n"
+    "- One value per day: 8,4,8\n"
+    "- A repeating pattern: 8x5,0x2 (five days of 8, then two days off)\n"
+    "- Weekdays only, skipping public holidays: 8 weekdays"
+)
+REQUEST_USAGE = (
+    "To request leave in one message:\n"
+    "/request YYYY-MM-DD..YYYY-MM-DD HOURS [weekdays] \"remarks\"\n"
+    "Example: /request 2025-03-03..2025-03-14 8 weekdays \"Family trip\"\n"
+    "Or send /request on its own to be asked step by step."
+)
+# Arguments of /request: dates, then optionally hours (e.g. "8x5,0x2" or "8 weekdays") and remarks
+REQUEST_ARGS = re.compile(
+    r'(?P<dates>\S+(?:\s+to\s+\S+)?)'
+    r'(?:\s+(?P<hours>(?:[\d.x,]+\s+)?weekdays(?:\s+only)?|[\d.x,]+))?'
+    r'(?:\s+(?P<remarks>.+))?',
+    re.DOTALL | re.IGNORECASE
+)
+HOURS_TERM = re.compile(r'(\d+(?:\.\d+)?)(?:x(\d+))?')
+
+def parse_dates(text):
+    """(start, end) dates from "YYYY-MM-DD", "YYYY-MM-DD to YYYY-MM-DD" or "YYYY-MM-DD..YYYY-MM-DD\""""
+    for separator in (" to ", ".."):
+        if separator in text:
+            start_text, end_text = text.split(separator)
+            break
+    else:
+        start_text = end_text = text
+    start_date = date.fromisoformat(start_text.strip())
+    end_date = date.fromisoformat(end_text.strip())
+    if start_date > end_date:
+        raise ValueError("Start date cannot be after end date")
+    return start_date, end_date
+
+def parse_hours(text, start_date, end_date, holiday_dates=frozenset()):
+    """(start, end, hours per day) for an hours expression over start_date..end_date
+
+    "8" is the same hours every day, "8,4,8" one value per day, and counted terms
+    like "8x5,0x2" repeat until the range is covered. A trailing "weekdays" (or
+    "weekdays only") applies the values to Monday to Friday except holiday_dates and
+    leaves the other days at 0; on its own it means full days. Days off at either
+    end are trimmed from the dates. Raises ValueError with a message for the user.
+    """
+    words = text.lower().split()
+    if words[-2:] == ['weekdays', 'only']:
+        words.pop()
+    weekdays = words[-1:] == ['weekdays']
+    if weekdays:
+        words.pop()
+    spec = ''.join(words) or (f"{MAX_HOURS_PER_DAY:g}" if weekdays else '')
+    days = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+    leave_days = [day for day in days if day.weekday() < 5 and day not in holiday_dates] if weekdays else days
+    if not leave_days:
+        raise ValueError("There are no weekdays in these dates outside public holidays.")
+    values = []
+    repeat = False
+    for term in spec.split(','):
+        match = HOURS_TERM.fullmatch(term.strip())
+        if match is None or float(match[1]) > MAX_HOURS_PER_DAY:
+            raise ValueError(
+                f"Invalid hours value: {term}\n"
+                f"Please enter numbers between 0 and {MAX_HOURS_PER_DAY:g}"
+            )
+        if match[2] is not None:
+            repeat = True
+        # A count longer than the range would only be cut off below
+        values.extend([float(match[1])] * min(int(match[2] or 1), len(leave_days)))
+    if repeat:
+        values = (values * (len(leave_days) // max(len(values), 1) + 1))[:len(leave_days)]
+    elif len(values) == 1:
+        values *= len(leave_days)
+    elif len(values) != len(leave_days):
+        unit = "weekday" if weekdays else "day"
+        raise ValueError(
+            f"Please provide {len(leave_days)} values (one for each {unit}), separated by commas.\n"
+            "Example: 8,4 for a full day followed by half day"
+        )
+    by_day = dict(zip(leave_days, values))
+    hours_per_day = [by_day.get(day, 0.0) for day in days]
+    leave = [i for i, hours in enumerate(hours_per_day) if hours]
+    if not leave:
+        raise ValueError(f"Please enter hours between 0 and {MAX_HOURS_PER_DAY:g} for at least one day.")
+    return days[leave[0]], days[leave[-1]], hours_per_day[leave[0]:leave[-1] + 1]
+
+def calendar_keyboard(month, picked=None):
+    """Inline keyboard of the days of month (any date in it) for picking leave dates
+
+    picked is a start date already chosen, shown in brackets; holidays are marked *.
+    """
+    first = month.replace(day=1)
+    previous_month = first - timedelta(days=1)
+    next_month = first + timedelta(days=32)
+    blank = InlineKeyboardButton(" ", callback_data="calendar_none")
+    rows = [
+        [
+            InlineKeyboardButton("«", callback_data=f"calendar_month_{previous_month:%Y-%m}"),
+            InlineKeyboardButton(f"{first:%B %Y}", callback_data="calendar_none"),
+            InlineKeyboardButton("»", callback_data=f"calendar_month_{next_month:%Y-%m}")
+        ],
+        [InlineKeyboardButton(name, callback_data="calendar_none") for name in ("Mo", "Tu", "We", "Th", "Fr", "Sa", "Su")]
+    ]
+    holiday_dates = holiday_calendar.dates()
+    week = [blank] * first.weekday()
+    day = first
+    while day.month == first.month:
+        label = str(day.day)
+        if day == picked:
+            label = f"[{label}]"
+        elif day in holiday_dates:
+            label += "*"
+        week.append(InlineKeyboardButton(label, callback_data=f"calendar_day_{day:%Y-%m-%d}"))
+        if len(week) == 7:
+            rows.append(week)
+            week = []
+        day += timedelta(days=1)
+    if week:
+        rows.append(week + [blank] * (7 - len(week)))
+    return InlineKeyboardMarkup(rows)
+
+async def find_conflicts(context, telegram_id, start_date, end_date):
+    """The user's pending and approved leave overlapping start_date..end_date"""
+    sync_shared_state(context.application)
+    try:
+        await history_index.load()
+    except Exception as e:
+        # Still check against pending requests and whatever history is already known
+        logger.warning("Error loading Leave History for overlap check: %s", e)
+    return leave_calendar.conflicts(telegram_id, start_date, end_date)
+
+@timed
 async def request_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Start the leave request process"""
-    await update.message.reply_text(
-        "Please enter the date(s) for your leave:\n"
-        "Format: YYYY-MM-DD or YYYY-MM-DD to YYYY-MM-DD\n"
-        "Example: 2025-02-15 or 2025-02-15 to 2025-02-17"
-    )
-    return DATES
+    """Start the leave request process, or submit it in one go from the command's arguments"""
+    # Taken from the text rather than context.args, which would lose the remarks' spacing
+    text = update.message.text.partition(' ')[2].strip()
+    if not text:
+        context.user_data.pop('picked_date', None)
+        await update.message.reply_text(DATES_PROMPT, reply_markup=calendar_keyboard(date.today()))
+        return DATES
+    match = REQUEST_ARGS.fullmatch(text)
+    try:
+        if match is None or (match['hours'] is None and match['remarks'] is not None):
+            raise ValueError("Invalid /request arguments")
+        start_date, end_date = parse_dates(match['dates'])
+    except ValueError:
+        await update.message.reply_text(REQUEST_USAGE)
+        return ConversationHandler.END
+    if match['hours'] is None:
+        # Dates only: carry on from the hours step
+        return await choose_dates(update, context, start_date, end_date)
+    try:
+        start_date, end_date, hours_per_day = parse_hours(
+            match['hours'], start_date, end_date, holiday_calendar.dates()
+        )
+    except ValueError as e:
+        await update.message.reply_text(f"{e}\n\n{REQUEST_USAGE}")
+        return ConversationHandler.END
+    remarks = match['remarks'] or "NIL"
+    if len(remarks) > 1 and remarks[0] in '"“' and remarks[-1] in '"”':
+        remarks = remarks[1:-1]
+    return await submit_request(update, context, start_date, end_date, hours_per_day, remarks)
+
+async def choose_dates(update, context, start_date, end_date):
+    """Keep the leave dates and ask for hours, or ask again if they overlap existing leave"""
+    conflicts = await find_conflicts(context, update.effective_user.id, start_date, end_date)
+    if conflicts:
+        await update.effective_message.reply_text(
+            format_conflicts(conflicts) + "\n\nPlease enter different dates, or /cancel.",
+            reply_markup=calendar_keyboard(start_date)
+        )
+        return DATES
 
+    context.user_data['start_date'] = start_date
+    context.user_data['end_date'] = end_date
+
+    days = (end_date - start_date).days + 1
+
+    if days == 1:
+        await update.effective_message.reply_text(
+            "Please enter the hours for this day:\n"
+            "Examples:\n"
+            "- Full day: 8\n"
+            "- Half day: 4"
+        )
+    else:
+        await update.effective_message.reply_text(HOURS_PROMPT.format(days=days))
+    return HOURS
+
+@timed
 async def handle_dates(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle date input"""
-    text = update.message.text
     try:
-        if " to " in text:
-            start_date_str, end_date_str = text.split(" to ")
-            start_date = datetime.strptime(start_date_str.strip(), "%Y-%m-%d")
-            end_date = datetime.strptime(end_date_str.strip(), "%Y-%m-%d")
-        else:
-            start_date = end_date = datetime.strptime(text.strip(), "%Y-%m-%d")
-        
-        if start_date > end_date:
-            raise ValueError("Start date cannot be after end date")
-            
-        context.user_data['start_date'] = start_date.strftime("%Y-%m-%d")
-        context.user_data['end_date'] = end_date.strftime("%Y-%m-%d")
-        
-        days = (end_date - start_date).days + 1
-        
-        if days == 1:
-            await update.message.reply_text(
-                "Please enter the hours for this day:\n"
-                "Examples:\n"
-                "- Full day: 8\n"
-                "- Half day: 4"
-            )
-        else:
-            await update.message.reply_text(
-                f"Please enter the hours for each day ({days} days):\n"
-                "Options:\n"
-                f"1. Same hours each day: enter a single number (e.g., 8 for {days} full days)\n"
-                f"2. Different hours: enter values separated by commas (e.g., 8,4 for full day then half day)\n\n"
-                "Examples:\n"
-                "- All full days: 8\n"
-                "- Full then half: 8,4\n"
-                "- Half then full: 4,8\n"
-                "- Different hours each day: 8,4,8"
-            )
-        return HOURS
-        
-    except ValueError as e:
+        start_date, end_date = parse_dates(update.message.text)
+    except ValueError:
         await update.message.reply_text(
             "Invalid date format. Please use YYYY-MM-DD.\n"
             "Example: 2025-02-15 or 2025-02-15 to 2025-02-17"
         )
         return DATES
+    return await choose_dates(update, context, start_date, end_date)
+
+@timed
+async def handle_calendar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle a press on the calendar keyboard: the first day tapped starts the leave, the next ends it"""
+    query = update.callback_query
+    _, action, value = (query.data.split('_', 2) + [''])[:3]
+    picked = context.user_data.get('picked_date')
+    if action == 'month':
+        await query.answer()
+        await query.edit_message_reply_markup(calendar_keyboard(date.fromisoformat(f"{value}-01"), picked))
+        return DATES
+    if action != 'day':
+        await query.answer()
+        return DATES
+    day = date.fromisoformat(value)
+    if picked is None or day < picked:
+        context.user_data['picked_date'] = day
+        await query.answer(f"Leave starts {day}. Now tap the last day, or the same day again for one day.")
+        await query.edit_message_reply_markup(calendar_keyboard(day, day))
+        return DATES
+    del context.user_data['picked_date']
+    await query.answer()
+    await query.edit_message_text(f"Dates: {picked} to {day}")
+    return await choose_dates(update, context, picked, day)
 
+@timed
 async def handle_hours(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle hours input"""
     try:
-        hours_input = update.message.text
-        
-        start_date = datetime.strptime(context.user_data['start_date'], "%Y-%m-%d")
-        end_date = datetime.strptime(context.user_data['end_date'], "%Y-%m-%d")
-        days = (end_date - start_date).days + 1
-        
-        hours_per_day = {}
-        
-        if ',' in hours_input:
-            hours_list = hours_input.split(',')
-            if len(hours_list) != days:
-                await update.message.reply_text(
-                    f"Please provide {days} values (one for each day), separated by commas.\n"
-                    "Example: 8,4 for a full day followed by half day"
-                )
-                return HOURS
-                
-            for i, hours in enumerate(hours_list):
-                current_date = (start_date + timedelta(days=i)).strftime("%Y-%m-%d")
-                try:
-                    hours_value = float(hours.strip())
-                    if hours_value <= 0 or hours_value > 8:
-                        raise ValueError
-                    hours_per_day[current_date] = hours_value
-                except ValueError:
-                    await update.message.reply_text(
-                        f"Invalid hours value: {hours}\n"
-                        "Please enter numbers between 0 and 8"
-                    )
-                    return HOURS
-        else:
-            try:
-                hours_value = float(hours_input)
-                if hours_value <= 0 or hours_value > 8:
-                    raise ValueError
-                current_date = start_date
-                while current_date <= end_date:
-                    hours_per_day[current_date.strftime("%Y-%m-%d")] = hours_value
-                    current_date += timedelta(days=1)
-            except ValueError:
-                await update.message.reply_text(
-                    "Invalid hours. Please enter a number between 0 and 8.\n"
-                    f"For different hours each day, use commas (e.g., 8,4 for {days} days)"
-                )
-                return HOURS
-        
-        context.user_data['hours_per_day'] = hours_per_day
-        
-        await update.message.reply_text(
-            "Please enter any remarks:\n"
-            "Purpose of leave, special instructions, etc.\n"
-            "Or put NIL if no remarks."
-        )
-        return REMARKS
-        
-    except ValueError:
-        await update.message.reply_text(
-            "Invalid hours. Please enter a number between 0 and 8."
+        start_date, end_date, hours_per_day = parse_hours(
+            update.message.text,
+            context.user_data['start_date'],
+            context.user_data['end_date'],
+            holiday_calendar.dates()
         )
+    except ValueError as e:
+        await update.message.reply_text(str(e))
         return HOURS
-    
+
+    # Days off at either end are no longer part of the request
+    context.user_data['start_date'] = start_date
+    context.user_data['end_date'] = end_date
+    context.user_data['hours_per_day'] = hours_per_day
+
+    await update.message.reply_text(
+        "Please enter any remarks:\n"
+        "Purpose of leave, special instructions, etc.\n"
+        "Or put NIL if no remarks."
+    )
+    return REMARKS
+
+@timed
 async def handle_remarks(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle remarks and create leave request"""
-    remarks = update.message.text
+    return await submit_request(
+        update,
+        context,
+        context.user_data['start_date'],
+        context.user_data['end_date'],
+        context.user_data['hours_per_day'],
+        update.message.text
+    )
+
+async def submit_request(update, context, start_date, end_date, hours_per_day, remarks):
+    """Create a leave request and send it to the supervisors"""
     user = update.effective_user
-    request_id = f"REQ_{datetime.now().strftime('%Y%m%d%H%M%S')}_{user.id}"
+    # The message ID keeps two requests sent in the same second apart; the Telegram ID
+    # stays last, where history_telegram_id() looks for it
+    request_id = f"REQ_{datetime.now().strftime('%Y%m%d%H%M%S')}_{update.effective_message.message_id}_{user.id}"
+    current_request_id.set(request_id)
+
+    # Another request for these dates may have been submitted since they were entered
+    conflicts = await find_conflicts(context, user.id, start_date, end_date)
+    if conflicts:
+        await update.message.reply_text(format_conflicts(conflicts) + "\n\nThis request was not submitted.")
+        context.user_data.clear()
+        return ConversationHandler.END
     
     # Create leave request
     leave_request = LeaveRequest(
         user.id,
         user.full_name,
         user.username,
-        context.user_data['start_date'],
-        context.user_data['end_date'],
-        context.user_data['hours_per_day'],
+        start_date,
+        end_date,
+        hours_per_day,
         remarks,
         request_id
     )
@@ -285,34 +2728,70 @@ async def handle_remarks(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if 'pending_requests' not in context.bot_data:
         context.bot_data['pending_requests'] = {}
     context.bot_data['pending_requests'][request_id] = leave_request
+    leave_calendar.add_pending(leave_request)
+    pending_store.save(leave_request)
+    logger.info("Leave request created by %s", user.id)
     
     # Notify supervisors
     await notify_supervisors(context, leave_request)
     
-    # Format hours display for confirmation
-    hours_display = format_hours_display(leave_request)
-    total_hours = sum(leave_request.hours_per_day.values())
-    
-    # Confirm to user
-    await update.message.reply_text(
-        f"Your leave request has been submitted:\n"
-        f"Dates: {context.user_data['start_date']} to {context.user_data['end_date']}\n"
-        f"Hours:\n" + "\n".join(hours_display) + f"\n"
-        f"Total Hours: {total_hours}\n"
-        f"Remarks: {remarks}\n"
-        f"Request ID: {request_id}\n\n"
-        "Supervisors have been notified."
-    )
+    # Confirm to user; sent alongside the supervisor post rather than after it
+    notifications.enqueue(update.effective_chat.id, render(SUBMITTED_TEMPLATE, leave_request))
     
     context.user_data.clear()
     return ConversationHandler.END
 
+@timed
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Cancel the request process"""
     await update.message.reply_text("Leave request cancelled.")
     context.user_data.clear()
     return ConversationHandler.END
 
+# /request steps by conversation state
+REQUEST_STEPS = {DATES: handle_dates, HOURS: handle_hours, REMARKS: handle_remarks}
+
+async def run_step(step, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Run a /request step and keep the state it returns in user_data
+
+    ConversationHandler would keep states in its own memory; in user_data they travel
+    with the rest of the conversation to whichever instance gets the next message.
+    """
+    state = await step(update, context)
+    if state == ConversationHandler.END:
+        context.user_data.pop('conversation', None)
+    else:
+        context.user_data['conversation'] = (update.effective_chat.id, state)
+
+def conversation_state(update, context):
+    """State of the user's /request conversation in this chat, or None"""
+    conversation = context.user_data.get('conversation')
+    if conversation and conversation[0] == update.effective_chat.id:
+        return conversation[1]
+    return None
+
+async def start_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # With arguments the request is complete in itself and replaces any conversation
+    if context.args or conversation_state(update, context) is None:
+        await run_step(request_command, update, context)
+
+async def continue_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Pass a text message on to the step the user's conversation is at"""
+    state = conversation_state(update, context)
+    if state is not None:
+        await run_step(REQUEST_STEPS[state], update, context)
+
+async def pick_dates(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Pass a calendar keyboard press on to the dates step, if the conversation is at it"""
+    if conversation_state(update, context) == DATES:
+        await run_step(handle_calendar, update, context)
+    else:
+        await update.callback_query.answer("This calendar is no longer in use. Send /request to start again.")
+
+async def cancel_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if conversation_state(update, context) is not None:
+        await run_step(cancel, update, context)
+
 async def notify_supervisors(context: ContextTypes.DEFAULT_TYPE, leave_request: LeaveRequest):
     """Send request to supervisor group"""
     keyboard = [
@@ -323,30 +2802,12 @@ async def notify_supervisors(context: ContextTypes.DEFAULT_TYPE, leave_request:
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    hours_display = format_hours_display(leave_request)
-    total_hours = sum(leave_request.hours_per_day.values())
-    
-    message = (
-        f"🔔 New Leave Request\n\n"
-        f"From: {leave_request.requester_name} (@{leave_request.requester_handle})\n"
-        f"Dates: {leave_request.start_date} to {leave_request.end_date}\n"
-        f"Hours:\n" + "\n".join(hours_display) + f"\n"
-        f"Total Hours: {total_hours}\n"
-        f"Remarks: {leave_request.remarks}\n"
-        f"Time: {leave_request.timestamp}"
-    )
-    
-    try:
-        await context.bot.send_message(
-            chat_id=SUPERVISOR_GROUP_ID,
-            text=message,
-            reply_markup=reply_markup
-        )
-    except Exception as e:
-        print(f"Error notifying supervisors: {e}")
+    message = render(SUPERVISOR_TEMPLATE, leave_request)
+    notifications.enqueue(SUPERVISOR_GROUP_ID, message, reply_markup=reply_markup)
 
 async def notify_duty_ops(context: ContextTypes.DEFAULT_TYPE, leave_request: LeaveRequest):
     """Send approved request to duty ops group"""
+    sync_shared_state(context.application)
     keyboard = [
         [
             InlineKeyboardButton("✅ Approve", callback_data=f"dutyops_approve_{leave_request.request_id}"),
@@ -355,53 +2816,68 @@ async def notify_duty_ops(context: ContextTypes.DEFAULT_TYPE, leave_request: Lea
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    hours_display = format_hours_display(leave_request)
-    total_hours = sum(leave_request.hours_per_day.values())
-    
-    message = (
-        f"🔔 Leave Request for Final Approval\n\n"
-        f"From: {leave_request.requester_name} (@{leave_request.requester_handle})\n"
-        f"Dates: {leave_request.start_date} to {leave_request.end_date}\n"
-        f"Hours:\n" + "\n".join(hours_display) + f"\n"
-        f"Total Hours: {total_hours}\n"
-        f"Remarks: {leave_request.remarks}\n"
-        f"Approved by: {leave_request.supervisor_approval}\n"
-        f"Time: {leave_request.timestamp}"
+    message = render(DUTY_OPS_TEMPLATE, leave_request, day_load="\n".join(format_day_load(leave_request)))
+    notifications.enqueue(DUTY_OPS_GROUP_ID, message, reply_markup=reply_markup)
+
+async def supervisor_approve(context: ContextTypes.DEFAULT_TYPE, leave_request: LeaveRequest, user):
+    """Record the supervisor's approval and pass the request on to Duty Ops
+
+    Returns False, changing nothing, if another press got there first.
+    """
+    approved = transition(
+        context, leave_request, PENDING_DUTY_OPS, supervisor_approval=user.full_name, supervisor_id=user.id
     )
-    
-    try:
-        await context.bot.send_message(
-            chat_id=DUTY_OPS_GROUP_ID,
-            text=message,
-            reply_markup=reply_markup
-        )
-    except Exception as e:
-        print(f"Error notifying duty ops: {e}")
+    if approved is None:
+        return False
+    await notify_duty_ops(context, approved)
+    return True
 
+def notify_approved(leave_request, duty_ops_name, new_balance):
+    """Tell the requester their leave was fully approved"""
+    notifications.enqueue(
+        leave_request.requester_id,
+        render(APPROVED_TEMPLATE, leave_request, duty_ops_name=duty_ops_name, new_balance=new_balance)
+    )
+
+@timed
 async def handle_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle supervisor's and duty ops' responses"""
     query = update.callback_query
-    await query.answer()
     
     parts = query.data.split('_', 2)
     if len(parts) != 3:
+        await query.answer()
         await query.edit_message_text("Error: Invalid callback data format")
         return
     
     approver_type, action, request_id = parts
-    request = context.bot_data['pending_requests'].get(request_id)
+    current_request_id.set(request_id)
+    request = find_request(context, request_id)
     
     if not request:
+        outcome = shared_state.get('outcomes', request_id)
+        if outcome:
+            # Repeated press on a finished request: tell the presser, leave the message alone
+            await query.answer(f"This request was already {outcome}.")
+            return
+        await query.answer()
         await query.edit_message_text("Error: Request not found or already processed.")
         return
     
+    expected_status = PENDING_SUPERVISOR if approver_type == "supervisor" else PENDING_DUTY_OPS
+    if request.status == APPROVING:
+        await query.answer("This request is being approved.")
+        return
+    if request.status != expected_status:
+        await query.answer("This request has already been handled at this stage.")
+        return
+    
     # Handle supervisor approval
     if approver_type == "supervisor" and action == "approve":
-        request.supervisor_approval = query.from_user.full_name
-        request.supervisor_id = query.from_user.id
-        
-        # Notify Duty Ops
-        await notify_duty_ops(context, request)
+        if not await supervisor_approve(context, request, query.from_user):
+            await query.answer("This request has already been handled at this stage.")
+            return
+        await query.answer()
         
         await query.edit_message_text(
             f"✅ Leave request approved by supervisor.\n"
@@ -411,106 +2887,641 @@ async def handle_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     # Handle Duty Ops approval
     elif approver_type == "dutyops" and action == "approve":
+        claimed = transition(context, request, APPROVING)
+        if claimed is None:
+            await query.answer("This request has already been handled at this stage.")
+            return
         try:
-            worksheet = client.open_by_key(SPREADSHEET_ID).sheet1
-            
-            cell = worksheet.find(str(request.requester_id))
-            if cell:
-                row = cell.row
-                total_hours = sum(request.hours_per_day.values())
-                
-                # Update leave balance
-                current_balance = float(worksheet.cell(row, 4).value)
-                new_balance = current_balance - total_hours
-                worksheet.update_cell(row, 4, new_balance)
-                
-                # Format hours for history
-                hours_breakdown = ",".join(str(h) for h in request.hours_per_day.values())
-                
-                history_sheet = client.open_by_key(SPREADSHEET_ID).worksheet("Leave History")
-                history_sheet.append_row([
-                    request.timestamp,
-                    request.requester_name,
-                    request.requester_handle,
-                    request.start_date,
-                    request.end_date,
-                    hours_breakdown,
-                    total_hours,
-                    request.remarks,
-                    request_id,
-                    request.supervisor_approval,
-                    query.from_user.full_name
-                ])
-                
-                # Notify user of approval
-                hours_display = format_hours_display(request)
-                await context.bot.send_message(
-                    chat_id=request.requester_id,
-                    text=f"✅ Your leave request has been fully approved!\n"
-                          f"Dates: {request.start_date} to {request.end_date}\n"
-                          f"Hours:\n" + "\n".join(hours_display) + f"\n"
-                          f"Total hours: {total_hours}\n"
-                          f"Approved by:\n"
-                          f"Supervisor: {request.supervisor_approval}\n"
-                          f"Duty Ops: {query.from_user.full_name}\n"
-                          f"Updated leave balance: {new_balance} hours"
-                )
-                
-                await query.edit_message_text(
-                    f"✅ Leave request fully approved and processed.\n"
-                    f"Request ID: {request_id}"
-                )
-                
-                # Remove from pending requests
-                del context.bot_data['pending_requests'][request_id]
-                
-            else:
-                raise Exception("User not found in leave balance sheet")
-                
+            await query.answer()
+            new_balance = await commit_approval(claimed, query.from_user.full_name)
         except Exception as e:
-            print(f"Error processing approval: {e}")
+            logger.exception("Error processing approval")
+            transition(context, claimed, PENDING_DUTY_OPS)
             await query.edit_message_text(
                 f"❌ Error processing approval: {str(e)}\n"
                 f"Request ID: {request_id}"
             )
+            return
+        
+        # Remove from pending requests
+        finish_request(context, request_id, "approved")
+        
+        # Notify user of approval
+        notify_approved(claimed, query.from_user.full_name, new_balance)
+        
+        await query.edit_message_text(
+            f"✅ Leave request fully approved and processed.\n"
+            f"Request ID: {request_id}"
+        )
             
     # Handle rejections from either supervisor or duty ops
     elif action == "reject":
+        if not pending_store.delete(request_id, expected_status=expected_status):
+            await query.answer("This request has already been handled at this stage.")
+            return
+        await query.answer()
         rejected_by = "Supervisor" if approver_type == "supervisor" else "Duty Ops"
-        await context.bot.send_message(
-            chat_id=request.requester_id,
-            text=f"❌ Your leave request has been rejected by {rejected_by}.\n"
-                 f"Dates: {request.start_date} to {request.end_date}"
+        notifications.enqueue(
+            request.requester_id,
+            f"❌ Your leave request has been rejected by {rejected_by}.\n"
+            f"Dates: {request.start_date} to {request.end_date}"
         )
         await query.edit_message_text(
             f"❌ Leave request rejected by {rejected_by}.\n"
             f"Request ID: {request_id}"
         )
-        del context.bot_data['pending_requests'][request_id]
+        finish_request(context, request_id, f"rejected by {rejected_by}")
+
+def approval_stage(chat_id):
+    """The status a group approves: supervisor group -> PENDING_SUPERVISOR, etc."""
+    if str(chat_id) == str(SUPERVISOR_GROUP_ID):
+        return PENDING_SUPERVISOR
+    if str(chat_id) == str(DUTY_OPS_GROUP_ID):
+        return PENDING_DUTY_OPS
+    return None
+
+def pending_list_text(context, entry):
+    """Text of a /pending list, numbered to match its toggle buttons"""
+    stage_name = "Supervisor" if entry['stage'] == PENDING_SUPERVISOR else "Duty Ops"
+    pending = context.bot_data.get('pending_requests', {})
+    lines = [f"📋 Requests awaiting {stage_name} approval: {entry['total']}"]
+    if entry['total'] > len(entry['request_ids']):
+        lines.append(f"Showing the oldest {len(entry['request_ids'])}.")
+    lines.append("")
+    for i, request_id in enumerate(entry['request_ids'], start=1):
+        request = pending.get(request_id)
+        if request is None or request.status != entry['stage']:
+            lines.append(f"{i}. (already handled) {request_id}")
+            continue
+        lines.append(
+            f"{i}. {request.requester_name} (@{request.requester_handle}): "
+            f"{request.start_date} to {request.end_date}, {request.total_hours:g} hours"
+        )
+    return "\n".join(lines)
+
+def pending_list_keyboard(entry):
+    """Toggle buttons five to a row, then the approve buttons"""
+    buttons = [
+        InlineKeyboardButton(
+            f"{'☑' if i in entry['selected'] else '☐'} {i + 1}", callback_data=f"pending_toggle_{i}"
+        )
+        for i in range(len(entry['request_ids']))
+    ]
+    keyboard = [buttons[i:i + 5] for i in range(0, len(buttons), 5)]
+    keyboard.append([
+        InlineKeyboardButton("✅ Approve all", callback_data="pending_approve_all"),
+        InlineKeyboardButton(
+            f"✅ Approve selected ({len(entry['selected'])})", callback_data="pending_approve_selected"
+        )
+    ])
+    return InlineKeyboardMarkup(keyboard)
+
+@timed
+async def list_pending(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """List requests waiting for this group's approval, with bulk approve buttons"""
+    stage = approval_stage(update.effective_chat.id)
+    if stage is None:
+        await update.message.reply_text("❌ Use /pending in the supervisor or Duty Ops group.")
+        return
+    sync_shared_state(context.application)
+    waiting = sorted(
+        (request for request in context.bot_data.get('pending_requests', {}).values()
+         if request.status == stage),
+        key=lambda request: request.timestamp
+    )
+    if not waiting:
+        await update.message.reply_text("No leave requests are waiting for approval.")
+        return
+    entry = {
+        'stage': stage,
+        'request_ids': [request.request_id for request in waiting[:PENDING_LIST_LIMIT]],
+        'total': len(waiting),
+        'selected': set()
+    }
+    message = await update.message.reply_text(
+        pending_list_text(context, entry), reply_markup=pending_list_keyboard(entry)
+    )
+    shared_state.put('pending_lists', f"{message.chat_id}:{message.message_id}", entry, keep=PENDING_LISTS_KEPT)
+
+@timed
+async def handle_pending_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the toggle and approve buttons of a /pending list"""
+    query = update.callback_query
+    _, action, argument = query.data.split('_', 2)
+    key = f"{query.message.chat_id}:{query.message.message_id}"
+    entry = shared_state.get('pending_lists', key)
+    if entry is None:
+        await query.answer("This list has expired. Send /pending again.")
+        return
+    sync_shared_state(context.application)
+
+    if action == "toggle":
+        entry['selected'] ^= {int(argument)}
+        shared_state.put('pending_lists', key, entry, keep=PENDING_LISTS_KEPT)
+        await query.answer()
+        await query.edit_message_text(pending_list_text(context, entry), reply_markup=pending_list_keyboard(entry))
+        return
+
+    if argument == "all":
+        chosen = entry['request_ids']
+    else:
+        chosen = [entry['request_ids'][i] for i in sorted(entry['selected'])]
+    if not chosen:
+        await query.answer("Select at least one request first.")
+        return
+    await query.answer()
+    shared_state.delete('pending_lists', key)
+    results = await approve_in_bulk(context, entry['stage'], chosen, query.from_user)
+    approved = sum(1 for line in results if line.startswith("✅"))
+    await query.edit_message_text(
+        f"Approved {approved} of {len(chosen)} requests by {query.from_user.full_name}:\n\n" + "\n".join(results)
+    )
+
+async def approve_in_bulk(context: ContextTypes.DEFAULT_TYPE, stage, request_ids, user):
+    """Approve requests at one stage as a batch; returns one result line per request
+
+    Duty Ops approvals are committed with commit_approvals (one ledger transaction and one
+    Sheets push); a request that fails is reported on its own line and the rest go ahead.
+    """
+    pending = context.bot_data.setdefault('pending_requests', {})
+    results = {}
+    batch = []
+    for request_id in request_ids:
+        request = pending.get(request_id)
+        if request is None or request.status != stage:
+            results[request_id] = f"⏭ {request_id}: already handled"
+        else:
+            batch.append(request)
+
+    if stage == PENDING_SUPERVISOR:
+        for request in batch:
+            current_request_id.set(request.request_id)
+            if not await supervisor_approve(context, request, user):
+                results[request.request_id] = f"⏭ {request.request_id}: already handled"
+                continue
+            logger.info("Leave request approved by supervisor in bulk")
+            results[request.request_id] = f"✅ {request.requester_name}: {request.start_date} to {request.end_date}"
+        return [results[request_id] for request_id in request_ids]
+
+    claimed = []
+    for request in batch:
+        claimed_request = transition(context, request, APPROVING)
+        if claimed_request is None:
+            results[request.request_id] = f"⏭ {request.request_id}: already handled"
+        else:
+            claimed.append(claimed_request)
+    try:
+        outcomes = await commit_approvals(claimed, user.full_name)
+    except Exception as e:
+        outcomes = [e] * len(claimed)
+    for request, outcome in zip(claimed, outcomes):
+        current_request_id.set(request.request_id)
+        if isinstance(outcome, Exception):
+            logger.error("Error processing approval: %s", outcome)
+            transition(context, request, PENDING_DUTY_OPS)
+            results[request.request_id] = f"❌ {request.requester_name} ({request.request_id}): {outcome}"
+            continue
+        notify_approved(request, user.full_name, outcome)
+        finish_request(context, request.request_id, "approved")
+        results[request.request_id] = f"✅ {request.requester_name}: {request.start_date} to {request.end_date}"
+    return [results[request_id] for request_id in request_ids]
+
+@timed
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show handler latency, Sheets usage and queue depths to admins"""
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("❌ This command is only available to administrators.")
+        return
+    
+    sync_shared_state(context.application)
+    message = "📈 Bot Statistics\n\nHandlers:\n"
+    for (name, labels), (_, total, count) in sorted(metrics.histograms.items()):
+        if name == 'leave_bot_handler_seconds':
+            p95 = metrics.quantile(name, labels, 0.95)
+            message += f"- {dict(labels)['handler']}: {count} calls, avg {total / count:.3f}s, p95 ≤{p95}s\n"
+    
+    message += "\nSheets calls:\n"
+    sheets_calls = {}
+    for (name, labels), value in metrics.counters.items():
+        if name == 'leave_bot_sheets_calls_total':
+            operation = dict(labels)['operation']
+            sheets_calls[operation] = sheets_calls.get(operation, 0) + value
+    for operation, value in sorted(sheets_calls.items()):
+        message += f"- {operation}: {value}\n"
+    
+    send_failures = sum(
+        value for (name, _), value in metrics.counters.items() if name == 'leave_bot_send_failures_total'
+    )
+    message += (
+        f"\nTelegram send failures: {send_failures}\n"
+        f"Notifications queued: {notifications.depth()}\n"
+        f"Ledger changes not yet in Sheets: {ledger.unsynced_count()}\n"
+        f"Pending requests: {len(context.bot_data.get('pending_requests', {}))}"
+    )
+    await update.message.reply_text(message)
+
+@timed
+async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send admins a CSV of leave taken per user and per team in a period"""
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("❌ This command is only available to administrators.")
+        return
+    try:
+        start_date, end_date, month = report_period(context.args)
+    except ValueError:
+        await update.message.reply_text(
+            "Usage: /report [YYYY-MM | YYYY-MM-DD YYYY-MM-DD]\n"
+            "Without arguments, reports last month."
+        )
+        return
+
+    sync_shared_state(context.application)
+    data = report_cache.get(month) if month else None
+    if data is None:
+        try:
+            teams = await read_teams(sheets)
+            unsynced = [history_record(telegram_id, values) for telegram_id, values in ledger.unsynced_history()]
+            leave_report = await build_report(sheets, start_date, end_date, teams, unsynced)
+        except Exception as e:
+            logger.exception("Error building leave report")
+            await update.message.reply_text(f"❌ Error building report: {str(e)}")
+            return
+        data = leave_report.to_csv().encode()
+        # Only closed months are cached; the current one still changes every day
+        if month and end_date < datetime.now().replace(hour=0, minute=0, second=0, microsecond=0):
+            report_cache[month] = data
+            while len(report_cache) > REPORT_CACHE_MONTHS:
+                report_cache.popitem(last=False)
+
+    period = f"{start_date:%Y-%m-%d} to {end_date:%Y-%m-%d}"
+    await update.message.reply_document(
+        document=data,
+        filename=f"leave_report_{start_date:%Y-%m-%d}_{end_date:%Y-%m-%d}.csv",
+        caption=f"📊 Leave report: {period}"
+    )
+
+def leader_only(job):
+    """Skip a background job on instances that do not hold the leader lease"""
+    @functools.wraps(job)
+    async def run(context):
+        if leader.is_leader:
+            await job(context)
+    return run
+
+async def renew_leader_lease(context: ContextTypes.DEFAULT_TYPE):
+    """Job: keep (or take over) the leader lease"""
+    leader.renew()
+
+@leader_only
+async def apply_balance_adjustments(context: ContextTypes.DEFAULT_TYPE):
+    """Job: credit this month's accrual once it is due and apply new adjustment CSVs"""
+    batches = []
+    now = datetime.now()
+    if ACCRUAL_HOURS and now.day >= ACCRUAL_DAY:
+        batches.append((f"accrual:{now:%Y-%m}", ACCRUAL_HOURS))
+    for path in sorted(glob.glob(os.path.join(ADJUSTMENTS_DIR, '*.csv'))):
+        try:
+            batches.append((f"adjustments:{os.path.basename(path)}", read_adjustments(path)))
+        except (OSError, ValueError) as e:
+            logger.error("Error reading balance adjustments %s: %s", path, e)
+    for batch, credits in batches:
+        try:
+            applied, unknown = await adjust_balances(batch, credits)
+        except Exception as e:
+            logger.warning("Error applying %s: %s", batch, e)
+            continue
+        if applied:
+            logger.info("Applied %s to %d balances", batch, applied)
+            metrics.inc('leave_bot_balance_adjustments_total', [('kind', batch.partition(':')[0])], applied)
+        if unknown:
+            logger.warning("%s: %d Telegram IDs not found in sheet1: %s", batch, len(unknown), ", ".join(unknown))
+
+@leader_only
+async def refresh_balance_index(context: ContextTypes.DEFAULT_TYPE):
+    """Periodically re-read sheet1, reconciling manual edits into the ledger"""
+    try:
+        await balance_index.refresh()
+    except Exception as e:
+        logger.warning("Error refreshing leave balances: %s", e)
+
+async def refresh_history_index(context: ContextTypes.DEFAULT_TYPE):
+    """Periodically rebuild the leave history index from the sheet"""
+    try:
+        await history_index.refresh()
+    except Exception as e:
+        logger.warning("Error refreshing leave history index: %s", e)
+
+@leader_only
+async def evict_expired_requests(context: ContextTypes.DEFAULT_TYPE):
+    """Drop pending requests older than PENDING_REQUEST_MAX_AGE_DAYS"""
+    sync_shared_state(context.application)
+    pending_requests = context.bot_data.setdefault('pending_requests', {})
+    for request_id in pending_store.evict_older_than(PENDING_REQUEST_MAX_AGE_DAYS * 86400):
+        request = pending_requests.get(request_id)
+        finish_request(context, request_id, "expired")
+        if request is None:
+            continue
+        notifications.enqueue(
+            request.requester_id,
+            f"⌛ Your leave request has expired without a decision.\n"
+            f"Dates: {request.start_date} to {request.end_date}\n"
+            f"Request ID: {request_id}\n"
+            "Please submit a new request if you still need the leave."
+        )
+    # An instance idle for longer than this reloads every pending request once
+    pending_store.trim_changes(86400)
+
+async def refresh_sheets_token(context: ContextTypes.DEFAULT_TYPE):
+    """Job: renew the Sheets access token ahead of expiry"""
+    try:
+        await sheets.refresh_token()
+    except Exception as e:
+        logger.warning("Error refreshing Google Sheets access token: %s", e)
+
+# Created by setup_services() once settings are loaded, so importing this module has no side effects
+sheets = None
+ledger = None
+balance_index = None
+history_index = None
+leave_calendar = None
+holiday_calendar = None
+ledger_sync = None
+pending_store = None
+notifications = None
+status_server = None
+shared_state = None
+leader = None
+warm_up_task = None
+
+def setup_services(authorize=authorize_sheets, state=None):
+    """Create the Sheets gateway, local stores and queues from the loaded settings
+
+    authorize is called on first use of Sheets, in a worker thread, to create the
+    gspread client; nothing talks to Google here. state is the state backend, by
+    default SqliteSharedState if SHARED_STATE_FILE is set, else LocalState.
+    """
+    global sheets, ledger, balance_index, history_index, leave_calendar, holiday_calendar, ledger_sync, pending_store
+    global notifications, status_server, shared_state, leader
+    if state is None:
+        state = SqliteSharedState(SHARED_STATE_FILE) if SHARED_STATE_FILE else LocalState()
+    shared_state = state
+    leader = LeaderLease(shared_state, INSTANCE_ID or f"{socket.gethostname()}:{os.getpid()}", LEADER_LEASE_SECONDS)
+    sheets = SheetsGateway(
+        authorize, SHEETS_MAX_WORKERS, SHEETS_TIMEOUTS,
+        SHEETS_READ_QUOTA, SHEETS_WRITE_QUOTA, SHEETS_MAX_RETRIES
+    )
+    ledger = Ledger(LEDGER_DB_FILE)
+    balance_index = BalanceIndex(sheets, ledger, BALANCE_INDEX_TTL, leader)
+    leave_calendar = LeaveCalendar()
+    holiday_calendar = HolidayCalendar(HOLIDAYS_FILE)
+    history_index = LeaveHistoryIndex(sheets, ledger, leave_calendar)
+    ledger_sync = LedgerSync(ledger, sheets, balance_index, LEDGER_SYNC_INTERVAL, leader)
+    pending_store = PendingRequestStore(PENDING_DB_FILE)
+    notifications = NotificationQueue(NOTIFY_MAX_RETRIES)
+    status_server = StatusServer(STATUS_LISTEN, STATUS_PORT)
+
+async def warm_up():
+    """Authorize Sheets and load the indexes without holding up the first update"""
+    try:
+        await sheets.refresh_token()
+        await balance_index.refresh()
+        await history_index.refresh()
+    except Exception as e:
+        # The indexes are loaded lazily on first use if Sheets is unavailable now
+        logger.warning("Error loading leave data at startup: %s", e)
+    else:
+        logger.info("Leave data loaded %.2fs after start", time.monotonic() - started_at)
+
+def settle_claims(application):
+    """Finish requests left APPROVING by a crash or restart between claim and finish_request
+
+    The ledger commit decides: a request with a Leave History row in the ledger was
+    approved and its hours deducted, anything else goes back to Duty Ops. A claim
+    another instance is working on right now may be released too, but the ledger
+    will not log a request twice, so it cannot be deducted twice.
+    """
+    pending_requests = application.bot_data['pending_requests']
+    for request in [request for request in pending_requests.values() if request.status == APPROVING]:
+        current_request_id.set(request.request_id)
+        values = ledger.approval(request.request_id)
+        if values is None:
+            logger.warning("Releasing an unfinished approval back to Duty Ops")
+            transition(application, request, PENDING_DUTY_OPS)
+            continue
+        logger.warning("Finishing an approval interrupted after it was committed")
+        if pending_store.delete(request.request_id, expected_status=APPROVING):
+            finish_request(application, request.request_id, "approved")
+            notify_approved(request, values[10], ledger.balance(request.requester_id))
+
+async def post_init(application: Application):
+    """Reload pending requests, start warming the Sheets indexes and schedule background jobs"""
+    global warm_up_task
+    leader.renew()
+    notifications.start(application.bot)
+    # Taken before the load, so a change made meanwhile is read again rather than missed
+    application.bot_data['pending_seq'] = pending_store.last_change()
+    application.bot_data['pending_requests'] = pending_store.load()
+    for request in application.bot_data['pending_requests'].values():
+        leave_calendar.add_pending(request)
+    settle_claims(application)
+    balance_index.load_ledger()
+    ledger_sync.start()
+    warm_up_task = asyncio.create_task(warm_up())
+    application.job_queue.run_repeating(
+        renew_leader_lease,
+        interval=LEADER_LEASE_SECONDS / 3,
+        first=LEADER_LEASE_SECONDS / 3
+    )
+    application.job_queue.run_repeating(
+        refresh_sheets_token,
+        interval=SHEETS_TOKEN_REFRESH_INTERVAL,
+        first=SHEETS_TOKEN_REFRESH_INTERVAL
+    )
+    application.job_queue.run_repeating(
+        refresh_balance_index,
+        interval=BALANCE_INDEX_TTL,
+        first=BALANCE_INDEX_TTL
+    )
+    application.job_queue.run_repeating(
+        refresh_history_index,
+        interval=HISTORY_REFRESH_INTERVAL,
+        first=HISTORY_REFRESH_INTERVAL
+    )
+    application.job_queue.run_repeating(evict_expired_requests, interval=3600, first=60)
+    # Idempotent per batch, so checking often catches up on accrual missed while the bot was down
+    application.job_queue.run_repeating(
+        apply_balance_adjustments,
+        interval=ADJUSTMENT_CHECK_INTERVAL,
+        first=120
+    )
+    metrics.gauge(
+        'leave_bot_notification_queue_depth', notifications.depth, 'Messages waiting to be sent'
+    )
+    metrics.gauge(
+        'leave_bot_update_queue_depth', application.update_queue.qsize, 'Updates waiting for a handler'
+    )
+    metrics.gauge(
+        'leave_bot_updates_in_flight',
+        lambda: application.update_processor.in_flight,
+        'Updates being handled right now'
+    )
+    metrics.gauge(
+        'leave_bot_ledger_unsynced', ledger.unsynced_count, 'Ledger changes not yet pushed to Sheets'
+    )
+    metrics.gauge(
+        'leave_bot_sheets_read_rate', lambda: sheets.read_throttle.rate, 'Sheets reads per minute allowed right now'
+    )
+    metrics.gauge(
+        'leave_bot_sheets_write_rate', lambda: sheets.write_throttle.rate, 'Sheets writes per minute allowed right now'
+    )
+    metrics.gauge(
+        'leave_bot_leader', lambda: int(leader.is_leader), '1 if this instance runs the singleton jobs'
+    )
+    metrics.gauge(
+        'leave_bot_pending_requests',
+        lambda: len(application.bot_data.get('pending_requests', {})),
+        'Leave requests awaiting a decision'
+    )
+    if STATUS_PORT is not None:
+        status_server.add_route('/healthz', lambda: health(application))
+        status_server.add_route('/metrics', lambda: (200, 'text/plain; version=0.0.4', metrics.render()))
+        await status_server.start()
+    startup_seconds = time.monotonic() - started_at
+    metrics.gauge(
+        'leave_bot_startup_seconds', lambda: startup_seconds, 'Seconds from process start until ready for updates'
+    )
+    logger.info("Ready for updates %.2fs after start", startup_seconds)
+
+def health(application):
+    """Health check: unhealthy once the application starts shutting down"""
+    if application.running:
+        return 200, 'text/plain', 'ok\n'
+    return 503, 'text/plain', 'stopping\n'
+
+async def post_stop(application: Application):
+    """Flush queued notifications and ledger changes before shutting down
 
-def main():
-    """Run the bot."""
-    application = Application.builder().token(BOT_TOKEN).build()
+    Application.stop() has already let in-flight handlers finish by this point.
+    """
+    if warm_up_task is not None and not warm_up_task.done():
+        warm_up_task.cancel()
+    await notifications.stop()
+    await ledger_sync.stop()
+    leader.release()
+    await status_server.stop()
 
-    # Create conversation handler
-    conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('request', request_command)],
-        states={
-            DATES: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_dates)],
-            HOURS: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_hours)],
-            REMARKS: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_remarks)]
-        },
-        fallbacks=[CommandHandler('cancel', cancel)]
+async def post_shutdown(application: Application):
+    """Release resources once the application has stopped"""
+    sheets.shutdown()
+    pending_store.close()
+    ledger.close()
+    shared_state.close()
+
+def build_application(bot=None, authorize=authorize_sheets, state=None):
+    """Build the Application with all handlers from the loaded settings
+
+    bot replaces the real Bot and authorize the Sheets client factory (e.g. in benchmarks);
+    state is a state backend for setup_services().
+    """
+    setup_services(authorize, state)
+    builder = Application.builder()
+    builder = builder.bot(bot) if bot is not None else builder.token(BOT_TOKEN)
+    application = (
+        builder
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(KeyedUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .build()
     )
 
+    if shared_state.shared:
+        # Around every update, so user_data (and the /request conversation in it) is shared
+        application.add_handler(TypeHandler(Update, load_user_state), group=-1)
+        application.add_handler(TypeHandler(Update, save_user_state), group=1)
+
     # Add handlers
     application.add_handler(CommandHandler("start", start))
-    application.add_handler(conv_handler)
+    application.add_handler(CommandHandler("request", start_request))
+    application.add_handler(CommandHandler("cancel", cancel_request))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, continue_request))
+    application.add_handler(CallbackQueryHandler(handle_pending_list, pattern=r'^pending_'))
+    application.add_handler(CallbackQueryHandler(pick_dates, pattern=r'^calendar_'))
     application.add_handler(CallbackQueryHandler(handle_response))
     application.add_handler(CommandHandler("balance", check_balance))
+    application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("pending", list_pending))
+    application.add_handler(CommandHandler("report", report))
+    return application
+
+def run_report(args):
+    """CLI: write a leave report CSV for a period straight from the sheet"""
+    try:
+        start_date, end_date, _ = report_period(args.period)
+    except ValueError:
+        print("Error: period must be YYYY-MM or two YYYY-MM-DD dates")
+        sys.exit(1)
+    gateway = SheetsGateway(
+        authorize_sheets, SHEETS_MAX_WORKERS, SHEETS_TIMEOUTS,
+        SHEETS_READ_QUOTA, SHEETS_WRITE_QUOTA, SHEETS_MAX_RETRIES
+    )
+
+    async def build():
+        try:
+            teams = await read_teams(gateway)
+            return await build_report(gateway, start_date, end_date, teams)
+        finally:
+            gateway.shutdown()
+
+    data = asyncio.run(build()).to_csv()
+    if args.output:
+        with open(args.output, 'w', newline='') as f:
+            f.write(data)
+    else:
+        sys.stdout.write(data)
+
+def main(argv=None):
+    """Run the bot, or the report command."""
+    parser = argparse.ArgumentParser(description="Leave request Telegram bot")
+    commands = parser.add_subparsers(dest='command')
+    report_parser = commands.add_parser('report', help="write a leave report CSV and exit")
+    report_parser.add_argument('period', nargs='*', help="YYYY-MM, or start and end YYYY-MM-DD (default: last month)")
+    report_parser.add_argument('-o', '--output', help="CSV file to write (default: stdout)")
+    args = parser.parse_args(argv)
+    try:
+        load_config(os.environ.get(ENV_PREFIX + 'CONFIG', 'config.py'), os.environ)
+    except ConfigError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    if args.command == 'report':
+        run_report(args)
+        return
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s",
+        level=LOG_LEVEL
+    )
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(RequestIdFilter())
+    # httpx logs every Bot API request at INFO
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    
+    application = build_application()
 
     # Start bot
-    application.run_polling()
+    if SERVE_MODE == 'webhook':
+        if not WEBHOOK_URL or not WEBHOOK_SECRET_TOKEN:
+            logger.error("Webhook mode needs WEBHOOK_URL and WEBHOOK_SECRET_TOKEN to be set")
+            sys.exit(1)
+        # Telegram sends the secret in a header; updates without it are rejected
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET_TOKEN
+        )
+    else:
+        application.run_polling()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file